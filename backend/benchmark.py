@@ -0,0 +1,177 @@
+import argparse, json, os, resource, subprocess, sys, time
+import scraper
+from scraper import PARSERS, PanelError, selectPanels, iterPisa, buildSearchQuery, URL, DETAIL_CONCURRENCY, PAGE_CONCURRENCY
+from http_client import HttpClient
+from replay import useArchive
+from course import Section
+
+# scraper benchmarks, none of which need a network
+#
+# compare the panel parsers on saved PISA search results pages
+# (e.g. save the response of a search in the browser, or use the ones in tests/fixtures):
+#   python benchmark.py parse page.html
+#   python benchmark.py parse tests/fixtures/pisa_results_2258.html -t 2258
+#
+# run every scraper mode against responses recorded with scraper.py --record:
+#   python scraper.py 2258 -g --record cache/fixtures.zip
+#   python scraper.py 2258 -p 500 --record cache/fixtures.zip
+#   python benchmark.py scrape cache/fixtures.zip 2258 --latency 0.05
+
+# options passed to iterPisa for each mode, paginated modes need a recording made with the same page size
+SCRAPE_MODES = {
+    "bs4": {"parser": "bs4"},
+    "lxml": {"parser": "lxml"},
+    "lxml-processes": {"parser": "lxml", "parse_workers": os.cpu_count()},
+    "lxml-paginated": {"parser": "lxml", "page_size": 500},
+    "lxml-detailed": {"parser": "lxml", "detailed": True},
+}
+
+def loadPages(paths: list[str]) -> list[bytes]:
+    pages = []
+    for path in paths:
+        with open(path, "rb") as file:
+            pages.append(file.read())
+    return pages
+
+def parseAll(pages: list[bytes], term: str, parser: str) -> list[Section]:
+    sections = []
+    for content in pages:
+        panels, parsePanel = selectPanels(content, parser)
+        for panel in panels:
+            try:
+                section = parsePanel(panel, term, False)
+            except PanelError:
+                continue
+            if section:
+                sections.append(section)
+    return sections
+
+# checks every parser produces the same sections as bs4, returns the first mismatch if any
+def checkParity(pages: list[bytes], term: str) -> str | None:
+    expected = parseAll(pages, term, "bs4")
+    for parser in PARSERS:
+        actual = parseAll(pages, term, parser)
+        if len(actual) != len(expected):
+            return f"{parser}: {len(actual)} sections, bs4: {len(expected)}"
+        for ours, theirs in zip(actual, expected):
+            if ours != theirs:
+                return f"{parser} differs on {theirs.id}: {ours} != {theirs}"
+    return None
+
+def benchmarkParsers(pages: list[bytes], term: str, rounds: int):
+    for parser in PARSERS:
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            count = len(parseAll(pages, term, parser))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{parser}: {count} sections in {best:.3f}s ({count / best:.0f} sections/s)")
+
+def percentiles(values: list[float]) -> dict:
+    values = sorted(values)
+    if not values:
+        return {"p50": 0, "p95": 0}
+    return {"p50": values[len(values) // 2], "p95": values[int(len(values) * 0.95)]}
+
+# times each panel of the recorded single-request search page on its own
+def panelParseTimes(archive, term: str, parser: str) -> list[float]:
+    try:
+        content = archive.load("POST", URL, buildSearchQuery(term)).content
+    except KeyError:
+        return []
+    panels, parsePanel = selectPanels(content, parser)
+    times = []
+    for panel in panels:
+        start = time.perf_counter()
+        try:
+            parsePanel(panel, term, False)
+        except PanelError:
+            pass
+        times.append(time.perf_counter() - start)
+    return times
+
+# runs one mode against the archive, in its own process so peak memory is per mode
+def runScrapeMode(archive_path: str, term: str, mode: str, latency: float) -> dict:
+    archive = useArchive(archive_path, "replay", latency)
+    scraper.search_client = HttpClient(max_concurrency=PAGE_CONCURRENCY)
+    scraper.detail_client = HttpClient(max_concurrency=DETAIL_CONCURRENCY)
+
+    start = time.perf_counter()
+    first_section = None
+    count = 0
+    for _ in iterPisa(term, **SCRAPE_MODES[mode]):
+        if first_section is None:
+            first_section = time.perf_counter() - start
+        count += 1
+    elapsed = time.perf_counter() - start
+
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        "sections": count,
+        "seconds": elapsed,
+        "sections_per_second": count / elapsed if elapsed else 0,
+        "first_section": first_section,
+        "search_fetch": percentiles(scraper.search_client.latencies),
+        "panel_parse": percentiles(panelParseTimes(archive, term, SCRAPE_MODES[mode]["parser"])),
+        "detail_fetch": percentiles(scraper.detail_client.latencies),
+        "peak_rss_mb": peak_kb / 1024,
+    }
+
+def benchmarkScrapeModes(archive_path: str, term: str, latency: float, modes: list[str]):
+    for mode in modes:
+        result = subprocess.run(
+            [sys.executable, __file__, "scrape-mode", archive_path, term, mode, "--latency", str(latency)],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        if result.returncode != 0:
+            print(f"{mode}: failed (missing fixtures for this mode?)")
+            continue
+        stats = json.loads(result.stdout.splitlines()[-1])
+        print(
+            f"{mode}: {stats['sections']} sections in {stats['seconds']:.2f}s ({stats['sections_per_second']:.0f}/s), "
+            f"first section after {stats['first_section'] or 0:.3f}s, peak rss {stats['peak_rss_mb']:.0f} MB"
+        )
+        for stage in ("search_fetch", "panel_parse", "detail_fetch"):
+            if stats[stage]["p50"]:
+                print(f"    {stage}: p50 {stats[stage]['p50'] * 1000:.2f}ms p95 {stats[stage]['p95'] * 1000:.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Scraper benchmarks.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parse_parser = subparsers.add_parser("parse", help="Check parser parity and report sections per second.")
+    parse_parser.add_argument("pages", nargs="+", help="Saved PISA search results pages.")
+    parse_parser.add_argument("-t", "--term", default="0000", help="Term code to tag parsed sections with.")
+    parse_parser.add_argument("-r", "--rounds", type=int, default=3, help="Runs per parser, the fastest is reported.")
+
+    scrape_parser = subparsers.add_parser("scrape", help="Run each scraper mode against a fixture archive.")
+    scrape_parser.add_argument("archive", help="Fixture archive recorded with scraper.py --record.")
+    scrape_parser.add_argument("term", help="Recorded term to scrape.")
+    scrape_parser.add_argument("-l", "--latency", type=float, default=0, help="Seconds of latency added to each replayed response.")
+    scrape_parser.add_argument("-m", "--modes", nargs="+", choices=SCRAPE_MODES, default=list(SCRAPE_MODES), help="Modes to run.")
+
+    # used by the scrape command to run each mode in a fresh process
+    mode_parser = subparsers.add_parser("scrape-mode")
+    mode_parser.add_argument("archive")
+    mode_parser.add_argument("term")
+    mode_parser.add_argument("mode", choices=SCRAPE_MODES)
+    mode_parser.add_argument("-l", "--latency", type=float, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == "parse":
+        pages = loadPages(args.pages)
+        mismatch = checkParity(pages, args.term)
+        if mismatch:
+            print(f"parity check failed: {mismatch}")
+            raise SystemExit(1)
+        print("parity check passed")
+        benchmarkParsers(pages, args.term, args.rounds)
+    elif args.command == "scrape":
+        benchmarkScrapeModes(args.archive, args.term, args.latency, args.modes)
+    elif args.command == "scrape-mode":
+        print(json.dumps(runScrapeMode(args.archive, args.term, args.mode, args.latency)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import io, json, os, random, threading, time
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from supabase import Client
+from metrics import metrics
+from course import Record, toRows
+
+BATCH_SIZE = 500
+WRITE_CONCURRENCY = 4
+WRITE_RETRIES = 3
+
+# set-based partial updates for SupabaseBulkWriter.update, postgrest can only PATCH one set of values per request
+# for setting up the function, e.g. in the supabase sql editor (`python bulk_writer.py` prints it)
+# it runs with the caller's privileges, and only the service role (the scraper's key) may call it
+BULK_UPDATE_FUNCTION = "bulk_update"
+BULK_UPDATE_FUNCTION_SQL = """CREATE OR REPLACE FUNCTION bulk_update(target regclass, key_column text, rows jsonb) RETURNS integer
+LANGUAGE plpgsql AS $$
+DECLARE
+    assignments text;
+    updated integer;
+BEGIN
+    -- every row in a call has the same columns, the key picks the row and the rest are set
+    SELECT string_agg(format('%I = source.%I', name, name), ', ') INTO assignments
+    FROM jsonb_object_keys(rows -> 0) AS name WHERE name <> key_column;
+    IF assignments IS NULL THEN
+        RETURN 0;
+    END IF;
+    EXECUTE format('UPDATE %s AS target SET %s FROM jsonb_populate_recordset(NULL::%s, $1) AS source WHERE target.%I = source.%I',
+                   target, assignments, target, key_column, key_column)
+    USING rows;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END
+$$;
+REVOKE EXECUTE ON FUNCTION bulk_update(regclass, text, jsonb) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION bulk_update(regclass, text, jsonb) TO service_role;"""
+
+def batched(rows: list, size: int) -> list[list]:
+    return [rows[i:i+size] for i in range(0, len(rows), size)]
+
+def printRate(table: str, count: int, elapsed: float):
+    print(f"{table}: wrote {count} rows in {elapsed:.2f}s ({count / elapsed if elapsed > 0 else 0:.0f} rows/s)")
+
+
+# upserts through supabase in batches, with a few batches in flight and retries per batch
+# a failed batch is retried on its own instead of failing the whole dataset
+# `concurrency` is shared by every thread using the writer, so it bounds database load globally
+class SupabaseBulkWriter:
+    def __init__(self, supabase: Client, table: str, batch_size: int = BATCH_SIZE, concurrency: int = WRITE_CONCURRENCY, retries: int = WRITE_RETRIES, backoff: float = 1.0):
+        self.supabase = supabase
+        self.table = table
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def _withRetries(self, request):
+        for attempt in range(self.retries + 1):
+            try:
+                return request()
+            except Exception as e:
+                metrics.error("upsert", e)
+                if attempt == self.retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                print(f"{self.table}: write failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _upsertBatch(self, batch: list[dict]) -> int:
+        with self.slots, metrics.time("upsert"):
+            self._withRetries(lambda: self.supabase.table(self.table).upsert(batch).execute())
+        metrics.count(f"{self.table}_rows_written", len(batch))
+        return len(batch)
+
+    def upsert(self, rows: list[dict | Record]) -> int:
+        if not rows:
+            return 0
+        rows = toRows(rows)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            count = sum(executor.map(self._upsertBatch, batched(rows, self.batch_size)))
+        printRate(self.table, count, time.perf_counter() - start)
+        return count
+
+    def _updateBatch(self, batch: list[dict], key: str) -> int:
+        with self.slots, metrics.time("update"):
+            self._withRetries(lambda: self.supabase.rpc(BULK_UPDATE_FUNCTION, {"target": self.table, "key_column": key, "rows": batch}).execute())
+        metrics.count(f"{self.table}_rows_written", len(batch))
+        return len(batch)
+
+    # sets the other columns of the existing rows matched by `key`, one bulk_update call per batch
+    # (an upsert of partial rows would try to insert them, failing NOT NULL columns or adding stub rows)
+    # rows are batched by shape, since each call sets the columns of its first row
+    def update(self, rows: list[dict | Record], key: str = "id") -> int:
+        if not rows:
+            return 0
+        rows = toRows(rows)
+        start = time.perf_counter()
+        shapes = {}
+        for row in rows:
+            shapes.setdefault(tuple(row.keys()), []).append(row)
+        batches = [batch for shape_rows in shapes.values() for batch in batched(shape_rows, self.batch_size)]
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            count = sum(executor.map(self._updateBatch, batches, repeat(key)))
+        printRate(self.table, count, time.perf_counter() - start)
+        return count
+
+    def delete(self, column: str, values: list):
+        for batch in batched(values, self.batch_size):
+            with self.slots:
+                self._withRetries(lambda: self.supabase.table(self.table).delete().in_(column, batch).execute())
+
+    def close(self):
+        pass
+
+
+# escapes a value for COPY's text format
+def copyValue(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+# direct postgres writer for local or self-hosted databases
+# COPYs rows into a temporary staging table, then merges them into the real table in one statement
+class PostgresBulkWriter:
+    def __init__(self, conn_string: str, table: str):
+        self.table = table
+        # one connection, so writes from concurrent terms take turns
+        self.lock = threading.Lock()
+        self.conn = psycopg2.connect(conn_string)
+        self.key_columns = self._primaryKey()
+
+    def _primaryKey(self) -> list[str]:
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "SELECT a.attname FROM pg_index i "
+                "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+                "WHERE i.indrelid = %s::regclass AND i.indisprimary",
+                (self.table,)
+            )
+            return [row[0] for row in cur.fetchall()]
+
+    def _stage(self, cur, columns: list[str], rows: list[dict]):
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(copyValue(row.get(column)) for column in columns))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        # only the written columns, without constraints, so partial rows can be staged for updates
+        cur.execute(f'CREATE TEMP TABLE staging AS SELECT {column_list} FROM "{self.table}" WITH NO DATA')
+        cur.copy_expert(f"COPY staging ({column_list}) FROM STDIN", buffer)
+
+    # upserts and updates match rows on the primary key, without one there's nothing to merge on
+    def _requireKey(self):
+        if not self.key_columns:
+            raise ValueError(f"{self.table} has no primary key, upserts and updates need one to match rows on")
+
+    def _merge(self, cur, columns: list[str]):
+        self._requireKey()
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in columns if column not in self.key_columns)
+        conflict = ", ".join(f'"{column}"' for column in self.key_columns)
+        action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        cur.execute(
+            f'INSERT INTO "{self.table}" ({column_list}) SELECT {column_list} FROM staging '
+            f"ON CONFLICT ({conflict}) {action}"
+        )
+
+    def _update(self, cur, columns: list[str]):
+        self._requireKey()
+        updates = ", ".join(f'"{column}" = staging."{column}"' for column in columns if column not in self.key_columns)
+        match = " AND ".join(f'target."{column}" = staging."{column}"' for column in self.key_columns)
+        cur.execute(f'UPDATE "{self.table}" AS target SET {updates} FROM staging WHERE {match}')
+
+    # stages each shape of row separately, since rows with different keys would null out each other's missing columns
+    def _write(self, rows: list[dict | Record], statement) -> int:
+        if not rows:
+            return 0
+        rows = toRows(rows)
+        start = time.perf_counter()
+
+        shapes = {}
+        for row in rows:
+            shapes.setdefault(tuple(row.keys()), []).append(row)
+
+        with self.lock, metrics.time("upsert"), self.conn, self.conn.cursor() as cur:
+            for columns, shape_rows in shapes.items():
+                self._stage(cur, list(columns), shape_rows)
+                statement(cur, list(columns))
+                cur.execute("DROP TABLE staging")
+
+        metrics.count(f"{self.table}_rows_written", len(rows))
+        printRate(self.table, len(rows), time.perf_counter() - start)
+        return len(rows)
+
+    def upsert(self, rows: list[dict | Record]) -> int:
+        return self._write(rows, self._merge)
+
+    # only touches existing rows, and only the columns present in `rows`
+    def update(self, rows: list[dict | Record]) -> int:
+        return self._write(rows, self._update)
+
+    def delete(self, column: str, values: list):
+        with self.lock, self.conn, self.conn.cursor() as cur:
+            cur.execute(f'DELETE FROM "{self.table}" WHERE "{column}" = ANY(%s)', (values,))
+
+    def close(self):
+        self.conn.close()
+
+
+# copy=True writes straight to postgres using SUPABASE_CONN_STRING instead of going through the supabase api
+def createWriter(supabase: Client, table: str, copy: bool = False, batch_size: int = BATCH_SIZE, concurrency: int = WRITE_CONCURRENCY):
+    if copy:
+        return PostgresBulkWriter(os.environ.get("SUPABASE_CONN_STRING"), table)
+    return SupabaseBulkWriter(supabase, table, batch_size, concurrency)
+
+
+if __name__ == "__main__":
+    print(BULK_UPDATE_FUNCTION_SQL)
@@ -0,0 +1,176 @@
+import argparse, ast, hashlib, json, mmap, os, pickle, shutil
+import numpy as np
+from course import Course, toRows
+
+COURSE_CORPUS_PATH = "cache/courses"
+EMBEDDING_CORPUS_PATH = "cache/class_embeddings"
+# sha1 hex digests
+ID_DTYPE = "S40"
+
+# a course keeps the same id across runs, so a changed course replaces its old record and document
+def courseId(course: dict) -> str:
+    return hashlib.sha1(f"{course['subject']} {course['number']}".encode()).hexdigest()
+
+# hash of the document text the course is embedded from
+def contentHash(course: dict) -> str:
+    return hashlib.sha1(str(course).encode()).hexdigest()
+
+# one record per course, the first listing of a course wins if it shows up twice
+def courseRecords(courses: list[Course | dict]) -> list[dict]:
+    records = {}
+    for course in toRows(courses):
+        id = courseId(course)
+        if id not in records:
+            records[id] = {"id": id, "content_hash": contentHash(course), "course": course}
+    return list(records.values())
+
+
+# on-disk course corpus, a directory of
+#   records.jsonl   one json record per line
+#   offsets.npy     int64 byte offset of each line in records.jsonl, plus the end of the file
+#   ids.npy         record ids, sorted, so a course can be found with a binary search
+#   hashes.npy      content hash of each record, for working out what changed without parsing records
+#   embeddings.npy  float32 matrix with one row per record (optional)
+#   terms.json      the terms the records were built from (optional, None if it wasn't recorded)
+# rows are sorted by id in every file. everything is opened with mmap, so loading reads nothing up front
+class Corpus:
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self.hashes = np.load(os.path.join(path, "hashes.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        embeddings_path = os.path.join(path, "embeddings.npy")
+        self.embeddings = np.load(embeddings_path, mmap_mode="r") if os.path.exists(embeddings_path) else None
+        terms_path = os.path.join(path, "terms.json")
+        self.terms = None
+        if os.path.exists(terms_path):
+            with open(terms_path) as file:
+                self.terms = json.load(file)
+
+        self.file = open(os.path.join(path, "records.jsonl"), "rb")
+        # mmap can't map an empty file
+        self.records = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if len(self.ids) else b""
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "ids.npy"))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: str) -> bool:
+        return self.row(id) is not None
+
+    def row(self, id: str) -> int | None:
+        key = id.encode()
+        row = int(np.searchsorted(self.ids, key))
+        if row < len(self.ids) and self.ids[row] == key:
+            return row
+        return None
+
+    def record(self, row: int) -> dict:
+        return json.loads(self.records[self.offsets[row]:self.offsets[row + 1]])
+
+    def get(self, id: str) -> dict | None:
+        row = self.row(id)
+        return self.record(row) if row is not None else None
+
+    # a view into the mapped matrix, copy it if it needs to outlive the corpus
+    def embedding(self, row: int) -> np.ndarray:
+        return self.embeddings[row]
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.record(row)
+
+    # {id: content hash} of every record
+    def contentHashes(self) -> dict[str, str]:
+        return {id.decode(): content_hash.decode() for id, content_hash in zip(self.ids, self.hashes)}
+
+    def close(self):
+        if isinstance(self.records, mmap.mmap):
+            self.records.close()
+        self.file.close()
+
+
+# writes records (dicts with "id" and "content_hash") and optionally their embeddings as a corpus at `path`
+# `terms` records which terms the records came from, so readers can tell a partial corpus from a full one
+# the corpus is built next to `path` and swapped in at the end, so readers never see a half-written one
+def writeCorpus(path: str, records: list[dict], embeddings: np.ndarray | list | None = None, terms: list[str] | None = None):
+    order = sorted(range(len(records)), key=lambda i: records[i]["id"])
+    ids = np.array([records[i]["id"] for i in order], dtype=ID_DTYPE)
+    if len(ids) > 1 and (ids[1:] == ids[:-1]).any():
+        raise ValueError("corpus records must have unique ids")
+
+    building = path + ".tmp"
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    with open(os.path.join(building, "records.jsonl"), "wb") as file:
+        for position, i in enumerate(order):
+            line = json.dumps(records[i]).encode() + b"\n"
+            file.write(line)
+            offsets[position + 1] = offsets[position] + len(line)
+
+    np.save(os.path.join(building, "ids.npy"), ids)
+    np.save(os.path.join(building, "hashes.npy"), np.array([records[i]["content_hash"] for i in order], dtype=ID_DTYPE))
+    np.save(os.path.join(building, "offsets.npy"), offsets)
+    if embeddings is not None:
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if len(matrix) != len(records):
+            raise ValueError(f"{len(matrix)} embeddings for {len(records)} records")
+        np.save(os.path.join(building, "embeddings.npy"), matrix[order] if len(order) else matrix)
+    if terms is not None:
+        with open(os.path.join(building, "terms.json"), "w") as file:
+            json.dump([str(term) for term in terms], file)
+
+    old = path + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(building, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+# one-time conversion of the old pickle caches
+#   cache/updatedclasses  (pickled list of course dicts)          -> COURSE_CORPUS_PATH
+#   cache/classembeddings (pickled haystack document embedder output) -> EMBEDDING_CORPUS_PATH
+# cache/classdocuments had no readers and is just removed
+def convertPickleCaches(cache_dir: str = "cache", remove: bool = False):
+    courses_path = os.path.join(cache_dir, "updatedclasses")
+    if os.path.exists(courses_path):
+        with open(courses_path, "rb") as file:
+            records = courseRecords(pickle.load(file))
+        writeCorpus(os.path.join(cache_dir, os.path.basename(COURSE_CORPUS_PATH)), records)
+        print(f"converted {len(records)} courses from {courses_path}")
+
+    embeddings_path = os.path.join(cache_dir, "classembeddings")
+    if os.path.exists(embeddings_path):
+        # unpickling the documents needs haystack installed
+        with open(embeddings_path, "rb") as file:
+            documents = pickle.load(file)["documents"]
+        records = {}
+        vectors = {}
+        for document in documents:
+            # documents were embedded from str(course), which is a python literal
+            course = ast.literal_eval(document.content)
+            record = courseRecords([course])[0]
+            if record["id"] not in records and document.embedding is not None:
+                records[record["id"]] = record
+                vectors[record["id"]] = document.embedding
+        writeCorpus(os.path.join(cache_dir, os.path.basename(EMBEDDING_CORPUS_PATH)), list(records.values()), [vectors[id] for id in records])
+        print(f"converted {len(records)} embedded documents from {embeddings_path}")
+
+    if remove:
+        for name in ("updatedclasses", "updatedclasses.json", "classembeddings", "classdocuments"):
+            if os.path.exists(os.path.join(cache_dir, name)):
+                os.remove(os.path.join(cache_dir, name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the old pickle caches to corpus directories.")
+    parser.add_argument("--cache-dir", default="cache", help="directory holding the pickle caches")
+    parser.add_argument("--remove", action="store_true", help="delete the pickle caches after converting")
+    args = parser.parse_args()
+    convertPickleCaches(args.cache_dir, args.remove)
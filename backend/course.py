@@ -1,17 +1,174 @@
-class Course:
-    def __init__(self, term, type, subject, number, title, description, gened, requirements, notes):
-        self.term = term
-        self.type = type
-        self.subject = subject
-        self.number = number
-        self.title = title
-        self.description = description
-        self.gened = gened
-        self.requirements = requirements
-        self.notes = notes
-    
-    def to_dict(self):
-        return self.__dict__
+import hashlib, json, marshal
+from dataclasses import dataclass, field
+
+# shared record types for the scraper, embedding and grades pipelines
+# slotted, so tens of thousands of them cost a fraction of the equivalent dicts
+#
+# to_dict() gives the database row (optional fields are left out until they're set, so partial scrapes
+# don't null out columns), pack()/unpack() is a compact binary form for handing records between processes,
+# and contentHash() is what change detection compares
+class Record:
+    __slots__ = ()
+    # fields left out of to_dict() while they're None
+    OPTIONAL: tuple[str, ...] = ()
+
+    @classmethod
+    def fieldNames(cls) -> tuple[str, ...]:
+        return tuple(cls.__dataclass_fields__)
+
+    def to_dict(self) -> dict:
+        row = {}
+        for name in self.fieldNames():
+            value = getattr(self, name)
+            if value is None and name in self.OPTIONAL:
+                continue
+            row[name] = value
+        return row
+
+    @classmethod
+    def from_dict(cls, row: dict):
+        return cls(**{name: row[name] for name in cls.fieldNames() if name in row})
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    def pack(self) -> bytes:
+        return marshal.dumps(tuple(getattr(self, name) for name in self.fieldNames()))
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        return cls(*marshal.loads(data))
+
+    # same digest as hashing the row dict with sorted keys, so hashes saved before records existed still match
+    def contentHash(self) -> str:
+        return hashlib.sha1(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()
+
+
+@dataclass(slots=True)
+class Course(Record):
+    term: str
+    type: str
+    subject: str
+    number: str
+    title: str
+    description: str
+    gened: str
+    requirements: str
+    notes: list | str
 
     def __str__(self):
-        return f"{', '.join(f'{key}={value}' for key, value in self.__dict__.items())}"
\ No newline at end of file
+        return f"{', '.join(f'{key}={value}' for key, value in self.to_dict().items())}"
+
+
+# one section of a course as scraped from PISA, a row of the courses table
+@dataclass(slots=True)
+class Section(Record):
+    OPTIONAL = ("gen_ed", "name", "description", "requirements", "notes")
+
+    id: str
+    term: int | str
+    department: str
+    course_number: str
+    course_letter: str
+    section_number: str
+    short_name: str
+    instructor: str
+    location: str
+    time: str
+    alt_location: str
+    alt_time: str
+    enrolled: str
+    type: str
+    summer_session: str
+    url: str
+    status: str
+    # from the class detail API, only with -g
+    gen_ed: str | None = None
+    name: str | None = None
+    description: str | None = None
+    requirements: str | None = None
+    notes: str | None = None
+
+    # the columns an --enrollment-only run would write for this section
+    def enrollment(self) -> "Enrollment":
+        return Enrollment(self.id, self.enrolled, self.status)
+
+
+# the columns --enrollment-only refreshes, written as partial updates of the courses table
+@dataclass(slots=True)
+class Enrollment(Record):
+    id: str
+    enrolled: str
+    status: str
+
+
+# grade counts for one offering of a course, a row of the grades table
+# counts maps grade columns (a_plus, a, b_minus, ...) to the number of students
+@dataclass(slots=True)
+class GradeDistribution(Record):
+    term: str
+    department: str
+    course_number: str
+    course_letter: str
+    short_name: str
+    instructor: str
+    counts: dict[str, int] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        row = {
+            "term": self.term,
+            "department": self.department,
+            "course_number": self.course_number,
+            "course_letter": self.course_letter,
+            "short_name": self.short_name,
+            "instructor": self.instructor,
+        }
+        row.update(self.counts)
+        return row
+
+    @classmethod
+    def from_dict(cls, row: dict):
+        fixed = ("term", "department", "course_number", "course_letter", "short_name", "instructor")
+        return cls(*(row[name] for name in fixed), {key: value for key, value in row.items() if key not in fixed})
+
+
+# grades rolled up across terms for a course, a course and instructor, or a whole department,
+# a row of the grade_aggregates table. key columns that don't apply to the scope are empty strings
+# counts is the histogram over the same grade columns as GradeDistribution
+@dataclass(slots=True)
+class GradeAggregate(Record):
+    scope: str
+    department: str
+    course_number: str
+    course_letter: str
+    instructor: str
+    offerings: int
+    first_term: str
+    last_term: str
+    # students with a letter grade, the ones gpa is over
+    students: int
+    gpa: float | None
+    pass_rate: float | None
+    counts: dict[str, int] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        row = {
+            "scope": self.scope,
+            "department": self.department,
+            "course_number": self.course_number,
+            "course_letter": self.course_letter,
+            "instructor": self.instructor,
+            "offerings": self.offerings,
+            "first_term": self.first_term,
+            "last_term": self.last_term,
+            "students": self.students,
+            "gpa": self.gpa,
+            "pass_rate": self.pass_rate,
+        }
+        row.update(self.counts)
+        return row
+
+
+# rows for a writer from records or plain dicts
+def toRows(records: list) -> list[dict]:
+    return [record.to_dict() if isinstance(record, Record) else record for record in records]
@@ -0,0 +1,50 @@
+import threading, time
+from metrics import metrics
+
+# seconds the server reuses the versions it read before asking the database again
+DATA_VERSION_POLL = 5
+
+# one row per term, bumped by the scraper whenever it writes changes to that term's sections
+# for setting up the table, e.g. in the supabase sql editor (`python data_version.py` prints it)
+DATA_VERSIONS_TABLE_SQL = "CREATE TABLE IF NOT EXISTS data_versions (term INTEGER PRIMARY KEY, version BIGINT NOT NULL)"
+
+# versions are millisecond timestamps, so concurrent scrapers never need to read a version to bump it
+# failing to bump only costs the server some stale cache hits, so it doesn't fail the scrape
+def bumpDataVersion(writer, term: int):
+    try:
+        writer.upsert([{"term": int(term), "version": int(time.time() * 1000)}])
+    except Exception as e:
+        metrics.error("data_version", e)
+
+
+# the server side, {term: version} as of at most DATA_VERSION_POLL seconds ago
+# current() returns None while the versions can't be read (e.g. the table doesn't exist yet),
+# callers should treat that as "nothing cached is known to be fresh"
+class DataVersions:
+    def __init__(self, pool, poll_interval: float = DATA_VERSION_POLL):
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.versions = None
+        self.checked = 0.0
+
+    def current(self) -> dict[int, int] | None:
+        with self.lock:
+            if time.monotonic() - self.checked < self.poll_interval:
+                return self.versions
+            # other requests keep using the old versions while this one polls
+            self.checked = time.monotonic()
+        try:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT term, version FROM data_versions")
+                versions = dict(cur.fetchall())
+        except Exception as e:
+            metrics.error("data_version", e)
+            versions = None
+        with self.lock:
+            self.versions = versions
+        return versions
+
+
+if __name__ == "__main__":
+    print(DATA_VERSIONS_TABLE_SQL)
@@ -0,0 +1,272 @@
+import argparse, os, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import psycopg2
+from metrics import metrics
+
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 8
+# seconds a request waits for a free connection before giving up
+POOL_ACQUIRE_TIMEOUT = 10
+# connections idle longer than this are pinged before being handed out
+POOL_CHECK_AFTER = 30
+# connections idle longer than this are closed instead of reused
+POOL_MAX_IDLE = 300
+STATEMENT_TIMEOUT_MS = 5000
+# recent checkout waits kept for the wait time percentiles, the pool lives as long as the server
+POOL_WAIT_SAMPLES = 1000
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# a connection string whose sessions get a statement timeout, for connections opened by other libraries
+# (e.g. haystack's document stores) that can't be set up the way the pool sets up its own
+# takes uri and key=value strings alike, and keeps any options already in the string
+def withStatementTimeout(conn_string: str, timeout_ms: int) -> str:
+    options = psycopg2.extensions.parse_dsn(conn_string).get("options", "")
+    return psycopg2.extensions.make_dsn(conn_string, options=f"{options} -c statement_timeout={int(timeout_ms)}".strip())
+
+
+# bounded, thread safe pool of read-only postgres connections, shared by every request of the server
+# each connection is set up once when it's opened (read-only session, statement timeout), checked out
+# for one query and rolled back on return, so the next request gets a clean connection without reconnecting
+# connections that went stale or broke mid-query are replaced instead of returned to the pool
+class ConnectionPool:
+    def __init__(self, conn_string: str, min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE,
+                 statement_timeout_ms: int = STATEMENT_TIMEOUT_MS, acquire_timeout: float = POOL_ACQUIRE_TIMEOUT,
+                 check_after: float = POOL_CHECK_AFTER, max_idle: float = POOL_MAX_IDLE, readonly: bool = True):
+        self.conn_string = conn_string
+        self.max_size = max_size
+        self.statement_timeout_ms = statement_timeout_ms
+        self.acquire_timeout = acquire_timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self.readonly = readonly
+
+        self.condition = threading.Condition()
+        # (connection, time it was returned), most recently used last
+        self.idle = []
+        # open connections, idle or checked out, plus ones being opened
+        self.size = 0
+        self.in_use = 0
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+        self.acquired = 0
+        self.waits = deque(maxlen=POOL_WAIT_SAMPLES)
+        self.closed = False
+
+        for _ in range(min_size):
+            with self.condition:
+                self.size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                raise
+            with self.condition:
+                self.idle.append((conn, time.monotonic()))
+
+    def _open(self):
+        conn = psycopg2.connect(self.conn_string)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET statement_timeout = %s", (self.statement_timeout_ms,))
+            conn.commit()
+            conn.set_session(readonly=self.readonly)
+        except Exception:
+            conn.close()
+            raise
+        with self.condition:
+            self.created += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.condition:
+            self.size -= 1
+            self.discarded += 1
+            self.condition.notify()
+
+    # pings connections that sat idle for a while, the server or a proxy may have dropped them
+    def _healthy(self, conn, idle_for: float) -> bool:
+        if conn.closed or idle_for > self.max_idle:
+            return False
+        if idle_for < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            conn = None
+            with self.condition:
+                while not self.idle and self.size >= self.max_size:
+                    if self.closed:
+                        raise PoolTimeout("connection pool is closed")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"no database connection free after {self.acquire_timeout}s ({self.max_size} in use)")
+                    self.condition.wait(remaining)
+                if self.closed:
+                    raise PoolTimeout("connection pool is closed")
+                if self.idle:
+                    conn, returned = self.idle.pop()
+                    idle_for = time.monotonic() - returned
+                else:
+                    # reserve the slot, the connection is opened outside the lock
+                    self.size += 1
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self.condition:
+                        self.size -= 1
+                        self.condition.notify()
+                    raise
+            elif not self._healthy(conn, idle_for):
+                self._discard(conn)
+                continue
+
+            with self.condition:
+                self.in_use += 1
+                self.acquired += 1
+                self.waits.append(time.perf_counter() - start)
+            return conn
+
+    # `broken` drops the connection instead of reusing it, e.g. after a connection error
+    def release(self, conn, broken: bool = False):
+        with self.condition:
+            self.in_use -= 1
+        if not broken and not conn.closed:
+            try:
+                # ends the read-only transaction the query ran in
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken or conn.closed or self.closed:
+            self._discard(conn)
+            return
+        with self.condition:
+            self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            # a lost connection shows up as conn.closed or a failed rollback, a timed out statement is just rolled back
+            self.release(conn)
+
+    def stats(self) -> dict:
+        with self.condition:
+            waits = sorted(self.waits)
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "max_size": self.max_size,
+                "created": self.created,
+                "discarded": self.discarded,
+                "timeouts": self.timeouts,
+                "acquired": self.acquired,
+                "wait_p50": waits[len(waits) // 2] if waits else 0,
+                "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0,
+                "wait_max": waits[-1] if waits else 0,
+            }
+
+    # prometheus gauges for the pool, to go alongside the metrics registry's output
+    def prometheus(self, prefix: str) -> str:
+        stats = self.stats()
+        lines = [f"# TYPE {prefix}_connections gauge"]
+        for state in ("size", "in_use", "idle", "max_size"):
+            lines.append(f'{prefix}_connections{{state="{state}"}} {stats[state]}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name in ("created", "discarded", "timeouts", "acquired"):
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {stats[name]}')
+        lines.append(f"# TYPE {prefix}_wait_seconds summary")
+        lines.append(f'{prefix}_wait_seconds{{quantile="0.5"}} {stats["wait_p50"]}')
+        lines.append(f'{prefix}_wait_seconds{{quantile="0.95"}} {stats["wait_p95"]}')
+        return "\n".join(lines) + "\n"
+
+    def printStats(self, name: str):
+        stats = self.stats()
+        print(f"{name}: {stats['in_use']} in use, {stats['idle']} idle, {stats['created']} created, {stats['discarded']} discarded, {stats['timeouts']} timed out, "
+              f"wait p50 {stats['wait_p50'] * 1000:.1f}ms p95 {stats['wait_p95'] * 1000:.1f}ms")
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.condition.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+# load test: `clients` threads each run `queries` statements through one pool
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Load test the read-only connection pool against a postgres database.")
+    parser.add_argument("--conn", default=os.getenv("SUPABASE_CONN_STRING"), help="connection string (default: SUPABASE_CONN_STRING)")
+    parser.add_argument("--query", default="SELECT 1", help="statement each client runs")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--queries", type=int, default=50, help="statements per client")
+    parser.add_argument("--max-size", type=int, default=POOL_MAX_SIZE, help="most connections open at once")
+    parser.add_argument("--statement-timeout", type=int, default=STATEMENT_TIMEOUT_MS, help="per-statement timeout in milliseconds")
+    parser.add_argument("--no-pool", action="store_true", help="connect for every statement instead, for comparison")
+    args = parser.parse_args()
+
+    pool = ConnectionPool(args.conn, max_size=args.max_size, statement_timeout_ms=args.statement_timeout)
+
+    def runQuery():
+        with metrics.time("query"):
+            if args.no_pool:
+                conn = psycopg2.connect(args.conn)
+                try:
+                    conn.set_session(readonly=True)
+                    with conn.cursor() as cur:
+                        cur.execute(args.query)
+                        cur.fetchall()
+                finally:
+                    conn.close()
+            else:
+                with pool.connection() as conn, conn.cursor() as cur:
+                    cur.execute(args.query)
+                    cur.fetchall()
+
+    def client(_):
+        for _ in range(args.queries):
+            try:
+                runQuery()
+            except Exception as e:
+                metrics.error("query", e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        list(executor.map(client, range(args.clients)))
+    elapsed = time.perf_counter() - start
+    print(f"{args.clients * args.queries} statements in {elapsed:.2f}s ({args.clients * args.queries / elapsed:.0f}/s)")
+    metrics.printSummary()
+    pool.printStats("connection pool")
+    pool.close()
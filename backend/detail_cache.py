@@ -0,0 +1,72 @@
+import json, os, sqlite3, threading, time, zlib
+from http_client import HttpClient
+
+CLASS_DETAIL_URL = "https://my.ucsc.edu/PSIGW/RESTListeningConnector/PSFT_CSPRD/SCX_CLASS_DETAIL.v1/"
+DETAIL_CACHE_PATH = "cache/class_details.sqlite"
+DETAIL_CACHE_TTL = 3600
+
+# sqlite cache of SCX_CLASS_DETAIL responses, keyed by (term, class_nbr) and stored as compressed json
+# past terms never change so they're kept forever, live terms (current/upcoming) expire after `ttl` seconds
+class DetailCache:
+    def __init__(self, path: str = DETAIL_CACHE_PATH, ttl: int = DETAIL_CACHE_TTL, live_terms: list = ()):
+        self.ttl = ttl
+        self.live_terms = {str(term) for term in live_terms}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        # one connection shared by every thread, sqlite calls are serialized with the lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS class_details ("
+            "term TEXT NOT NULL, class_nbr TEXT NOT NULL, fetched_at REAL NOT NULL, data BLOB NOT NULL, "
+            "PRIMARY KEY (term, class_nbr))"
+        )
+        self.conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, term, class_nbr) -> dict | None:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT fetched_at, data FROM class_details WHERE term = ? AND class_nbr = ?",
+                (str(term), str(class_nbr))
+            ).fetchone()
+        if row is None:
+            return None
+        fetched_at, data = row
+        if str(term) in self.live_terms and time.time() - fetched_at > self.ttl:
+            return None
+        return json.loads(zlib.decompress(data))
+
+    def put(self, term, class_nbr, detail: dict):
+        data = zlib.compress(json.dumps(detail).encode())
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO class_details (term, class_nbr, fetched_at, data) VALUES (?, ?, ?, ?)",
+                (str(term), str(class_nbr), time.time(), data)
+            )
+            self.conn.commit()
+
+    # read-through lookup, only successful responses are cached
+    def fetch(self, client: HttpClient, term, class_nbr) -> dict:
+        detail = self.get(term, class_nbr)
+        if detail is not None:
+            with self.lock:
+                self.hits += 1
+            return detail
+
+        with self.lock:
+            self.misses += 1
+        response = client.get(CLASS_DETAIL_URL + f"{term}/{class_nbr}")
+        detail = response.json()
+        if response.status_code == 200:
+            self.put(term, class_nbr, detail)
+        return detail
+
+    def printStats(self, name: str):
+        print(f"{name}: {self.hits} hits, {self.misses} misses")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,82 @@
+import os, sqlite3, threading
+from array import array
+from collections import OrderedDict
+from typing import Callable
+from metrics import metrics
+
+QUERY_EMBEDDING_CACHE_PATH = "cache/query_embeddings.sqlite"
+QUERY_EMBEDDING_ENTRIES = 4096
+
+# queries differing only in case or spacing share an embedding
+def normalizeQuery(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+# cache of query embeddings for retrieve_general, so repeated questions skip the embedding api
+# an in-process LRU in front of an optional sqlite file that keeps embeddings across restarts
+# `namespace` (e.g. the embedding model) is part of every key, so switching models never serves stale vectors
+class QueryEmbeddingCache:
+    def __init__(self, embed: Callable[[str], list[float]], path: str | None = QUERY_EMBEDDING_CACHE_PATH, max_entries: int = QUERY_EMBEDDING_ENTRIES, namespace: str = ""):
+        self.embed = embed
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.conn = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # shared by the server's worker threads, every use is under self.lock
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+            self.conn.commit()
+
+    def _remember(self, key: str, embedding: list[float]):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _lookup(self, key: str) -> list[float] | None:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metrics.count("query_embedding_hits")
+                return self.entries[key]
+            if self.conn:
+                row = self.conn.execute("SELECT embedding FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+                if row:
+                    embedding = array("f", row[0]).tolist()
+                    self._remember(key, embedding)
+                    metrics.count("query_embedding_disk_hits")
+                    return embedding
+        return None
+
+    def get(self, text: str) -> list[float]:
+        key = f"{self.namespace}:{normalizeQuery(text)}"
+        embedding = self._lookup(key)
+        if embedding is not None:
+            return embedding
+
+        # two requests for the same new query may both embed it, which is harmless
+        metrics.count("query_embedding_misses")
+        embedding = self.embed(" ".join(text.split()))
+        with self.lock:
+            self._remember(key, embedding)
+            if self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO query_embeddings VALUES (?, ?)", (key, array("f", embedding).tobytes()))
+                self.conn.commit()
+        return embedding
+
+    # embeds anything in `texts` that isn't cached yet, e.g. the suggested questions at startup
+    def warm(self, texts: list[str]):
+        for text in texts:
+            try:
+                self.get(text)
+            except Exception as e:
+                metrics.error("query_embedding", e)
+
+    def close(self):
+        if self.conn:
+            with self.lock:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,111 @@
+import hashlib, json, os, random, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+from haystack import Document
+from metrics import metrics
+
+EMBEDDING_CHECKPOINT_PATH = "cache/embedding_checkpoint.jsonl"
+EMBED_BATCH_SIZE = 100
+EMBED_CONCURRENCY = 2
+EMBED_RETRIES = 5
+EMBEDDING_DIMENSION = 768
+
+# embeds documents in batches, a few batches at a time, retrying each batch with backoff
+# every finished batch is appended to a checkpoint file, so a crash or quota error only loses the batches in flight
+# and running the job again picks up from there. checkpoint entries are matched on document id and content hash,
+# so entries for documents that changed since are ignored
+class EmbeddingJob:
+    def __init__(self, embed: Callable[[list[Document]], list[Document]], checkpoint_path: str = EMBEDDING_CHECKPOINT_PATH, batch_size: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY, retries: int = EMBED_RETRIES, backoff: float = 2.0):
+        # embed(documents) returns the documents with their embedding set, like a haystack document embedder
+        self.embed = embed
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+
+    # {(id, content hash): embedding} from an earlier, unfinished run
+    def loadCheckpoint(self) -> dict[tuple[str, str], list[float]]:
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        embeddings = {}
+        with open(self.checkpoint_path) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is cut off if the job died while writing it
+                    continue
+                embeddings[(entry["id"], entry["content_hash"])] = entry["embedding"]
+        return embeddings
+
+    def _saveBatch(self, documents: list[Document]):
+        lines = "".join(
+            json.dumps({"id": document.id, "content_hash": document.meta["content_hash"], "embedding": document.embedding}) + "\n"
+            for document in documents
+        )
+        with self.lock, open(self.checkpoint_path, "a") as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _embedBatch(self, batch: list[Document]) -> list[Document]:
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.time("embedding"):
+                    embedded = self.embed(batch)
+                break
+            except Exception as e:
+                metrics.error("embedding", e)
+                if attempt == self.retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                print(f"embedding batch failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        self._saveBatch(embedded)
+        metrics.count("documents_embedded", len(embedded))
+        return embedded
+
+    # returns every document with its embedding, in the original order
+    def run(self, documents: list[Document]) -> list[Document]:
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        checkpoint = self.loadCheckpoint()
+
+        done = {}
+        pending = []
+        for document in documents:
+            embedding = checkpoint.get((document.id, document.meta["content_hash"]))
+            if embedding is not None:
+                document.embedding = embedding
+                done[document.id] = document
+            else:
+                pending.append(document)
+        if done:
+            print(f"resuming from checkpoint, {len(done)} documents already embedded")
+
+        batches = [pending[i:i+self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = [executor.submit(self._embedBatch, batch) for batch in batches]
+            for future in as_completed(futures):
+                for document in future.result():
+                    done[document.id] = document
+
+        return [done[document.id] for document in documents]
+
+    # call once the embeddings are safely stored, so the next run starts fresh
+    def clear(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+# deterministic stand-in for a real embedder, for running the job locally without an api key
+# documents with the same content get the same unit vector
+def fakeEmbed(documents: list[Document]) -> list[Document]:
+    for document in documents:
+        seed = int(hashlib.sha1(document.content.encode()).hexdigest()[:16], 16)
+        generator = random.Random(seed)
+        vector = [generator.gauss(0, 1) for _ in range(EMBEDDING_DIMENSION)]
+        norm = sum(value * value for value in vector) ** 0.5
+        document.embedding = [value / norm for value in vector]
+    return documents
@@ -0,0 +1,167 @@
+import json, os, sqlite3
+from course import GradeDistribution, GradeAggregate
+
+GRADE_LEDGER_PATH = "cache/grade_ledger.sqlite"
+
+# grade columns of the grades table, in histogram order
+GRADE_COLUMNS = ["a_plus", "a", "a_minus", "b_plus", "b", "b_minus", "c_plus", "c", "c_minus", "d_plus", "d", "d_minus", "f", "p", "np", "s", "u", "i", "w"]
+GRADE_POINTS = {
+    "a_plus": 4.0, "a": 4.0, "a_minus": 3.7,
+    "b_plus": 3.3, "b": 3.0, "b_minus": 2.7,
+    "c_plus": 2.3, "c": 2.0, "c_minus": 1.7,
+    "d_plus": 1.3, "d": 1.0, "d_minus": 0.7,
+    "f": 0.0,
+}
+# C or better passes, as does P/S. incompletes and withdrawals don't count either way
+PASSING = {"a_plus", "a", "a_minus", "b_plus", "b", "b_minus", "c_plus", "c", "p", "s"}
+FAILING = {"c_minus", "d_plus", "d", "d_minus", "f", "np", "u"}
+
+# columns of the ledger's dirty table
+DIRTY_COLUMNS = ("scope", "department", "course_number", "course_letter", "instructor")
+# dirty keys looked up in one query
+AGGREGATE_KEYS_PER_QUERY = 500
+
+# scopes aggregates are kept for, with the key columns that identify one
+SCOPES = {
+    "course": ("department", "course_number", "course_letter"),
+    "course_instructor": ("department", "course_number", "course_letter", "instructor"),
+    "department": ("department",),
+}
+
+# for setting up the aggregates table, e.g. in the supabase sql editor
+AGGREGATES_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS grade_aggregates ("
+    "scope TEXT NOT NULL, department TEXT NOT NULL, course_number TEXT NOT NULL, course_letter TEXT NOT NULL, instructor TEXT NOT NULL, "
+    "offerings INTEGER NOT NULL, first_term TEXT, last_term TEXT, students INTEGER NOT NULL, gpa REAL, pass_rate REAL, "
+    + ", ".join(f"{column} INTEGER NOT NULL DEFAULT 0" for column in GRADE_COLUMNS) +
+    ", PRIMARY KEY (scope, department, course_number, course_letter, instructor))"
+)
+
+# multi-instructor offerings are stored as "Casey,C.B., Lee,A.", each instructor gets the whole offering
+def splitInstructors(instructor: str) -> list[str]:
+    return [name for name in instructor.split(", ") if name]
+
+def gradeStats(counts: dict[str, int]) -> tuple[int, float | None, float | None]:
+    students = sum(counts.get(column, 0) for column in GRADE_POINTS)
+    points = sum(counts.get(column, 0) * value for column, value in GRADE_POINTS.items())
+    passed = sum(counts.get(column, 0) for column in PASSING)
+    decided = passed + sum(counts.get(column, 0) for column in FAILING)
+    return students, round(points / students, 3) if students else None, round(passed / decided, 4) if decided else None
+
+
+# (SELECT ... FROM part of the query rolling grades rows up to one scope, its key columns)
+# each row is the key, then the offering count, first and last term and the summed grade columns
+def _scopeQuery(scope: str) -> tuple[str, str]:
+    sums = ", ".join(f"COALESCE(SUM({column}), 0)" for column in GRADE_COLUMNS)
+    if scope == "course_instructor":
+        # multi-instructor offerings count for each of their instructors, like splitInstructors
+        keys = "department, course_number, course_letter, name"
+        source = "grades CROSS JOIN LATERAL unnest(string_to_array(instructor, ', ')) AS name"
+    else:
+        keys = ", ".join(SCOPES[scope])
+        source = "grades"
+    return f"SELECT {keys}, COUNT(*), MIN(term)::text, MAX(term)::text, {sums} FROM {source}", keys
+
+def _toAggregate(scope: str, row: tuple) -> GradeAggregate:
+    width = len(SCOPES[scope])
+    key = dict(zip(SCOPES[scope], row[:width]))
+    offerings, first_term, last_term = row[width:width + 3]
+    counts = dict(zip(GRADE_COLUMNS, row[width + 3:]))
+    students, gpa, pass_rate = gradeStats(counts)
+    return GradeAggregate(
+        scope, key["department"], key.get("course_number", ""), key.get("course_letter", ""), key.get("instructor", ""),
+        offerings, first_term, last_term, students, gpa, pass_rate, counts,
+    )
+
+# aggregates for the given keys of one scope, computed from the grades table (the only complete copy of the grades)
+# keys with no grades left get an empty aggregate, so their old row is overwritten rather than left stale
+def aggregateFromGrades(conn, scope: str, keys: list[tuple]) -> list[GradeAggregate]:
+    select, key_columns = _scopeQuery(scope)
+    aggregates = {}
+    with conn.cursor() as cur:
+        for start in range(0, len(keys), AGGREGATE_KEYS_PER_QUERY):
+            batch = tuple(keys[start:start + AGGREGATE_KEYS_PER_QUERY])
+            cur.execute(f"{select} WHERE ({key_columns}) IN %s GROUP BY {key_columns}", (batch,))
+            for row in cur.fetchall():
+                aggregates[tuple(row[:len(SCOPES[scope])])] = _toAggregate(scope, row)
+    empty = (0, None, None) + (0,) * len(GRADE_COLUMNS)
+    return [aggregates.get(tuple(key)) or _toAggregate(scope, tuple(key) + empty) for key in keys]
+
+# every aggregate of one scope, for rebuilding the table
+def allAggregatesFromGrades(conn, scope: str) -> list[GradeAggregate]:
+    select, key_columns = _scopeQuery(scope)
+    with conn.cursor() as cur:
+        cur.execute(f"{select} GROUP BY {key_columns}")
+        return [_toAggregate(scope, row) for row in cur.fetchall()]
+
+
+# local record of the offerings ingested on this machine, used to work out which aggregates new grades touch
+# recording an offering whose counts changed marks the aggregates it feeds as dirty, and refreshing recomputes
+# only those. the ledger only decides *what* to refresh: the values always come from the grades table, since
+# this machine may not have ingested every dump. ingesting the same file twice touches none.
+# safe to share between the ingest worker processes
+class GradeLedger:
+    def __init__(self, path: str = GRADE_LEDGER_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS offerings ("
+            "term TEXT NOT NULL, department TEXT NOT NULL, course_number TEXT NOT NULL, course_letter TEXT NOT NULL, "
+            "short_name TEXT NOT NULL, instructor TEXT NOT NULL, counts TEXT NOT NULL, "
+            "PRIMARY KEY (term, department, course_number, course_letter, short_name, instructor))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dirty ("
+            "scope TEXT NOT NULL, department TEXT NOT NULL, course_number TEXT NOT NULL, course_letter TEXT NOT NULL, instructor TEXT NOT NULL, "
+            "PRIMARY KEY (scope, department, course_number, course_letter, instructor))"
+        )
+        self.conn.commit()
+
+    def record(self, grades: list[GradeDistribution]) -> int:
+        changed = 0
+        with self.conn:
+            for grade in grades:
+                key = (grade.term, grade.department, grade.course_number, grade.course_letter, grade.short_name, grade.instructor)
+                counts = json.dumps(grade.counts, sort_keys=True)
+                row = self.conn.execute(
+                    "SELECT counts FROM offerings WHERE term = ? AND department = ? AND course_number = ? AND course_letter = ? AND short_name = ? AND instructor = ?",
+                    key
+                ).fetchone()
+                if row and row[0] == counts:
+                    continue
+                self.conn.execute("INSERT OR REPLACE INTO offerings VALUES (?, ?, ?, ?, ?, ?, ?)", key + (counts,))
+                self._markDirty(grade)
+                changed += 1
+        return changed
+
+    def _markDirty(self, grade: GradeDistribution):
+        keys = [
+            ("course", grade.department, grade.course_number, grade.course_letter, ""),
+            ("department", grade.department, "", "", ""),
+        ]
+        keys += [("course_instructor", grade.department, grade.course_number, grade.course_letter, name) for name in splitInstructors(grade.instructor)]
+        self.conn.executemany("INSERT OR IGNORE INTO dirty VALUES (?, ?, ?, ?, ?)", keys)
+
+    # recomputes the dirty aggregates from the grades table (`grades_conn`, a postgres connection) and writes them
+    # with `writer`, clearing them only once they're written. rebuild recomputes every aggregate instead
+    def refresh(self, writer, grades_conn, rebuild: bool = False) -> int:
+        dirty = self.conn.execute("SELECT scope, department, course_number, course_letter, instructor FROM dirty").fetchall()
+        if rebuild:
+            aggregates = [aggregate for scope in SCOPES for aggregate in allAggregatesFromGrades(grades_conn, scope)]
+        else:
+            aggregates = []
+            for scope, key_columns in SCOPES.items():
+                keys = [tuple(key[DIRTY_COLUMNS.index(column)] for column in key_columns) for key in dirty if key[0] == scope]
+                if keys:
+                    aggregates += aggregateFromGrades(grades_conn, scope, keys)
+        if aggregates:
+            writer.upsert(aggregates)
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM dirty WHERE scope = ? AND department = ? AND course_number = ? AND course_letter = ? AND instructor = ?",
+                dirty
+            )
+        return len(aggregates)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,148 @@
+import random, threading, time
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+import replay
+from metrics import metrics, TIMER_SAMPLES
+
+# statuses worth retrying, anything else is returned to the caller as-is
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# token bucket shared by every thread using a client
+# refills at `rate` tokens per second, up to `burst` tokens
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# pooled, rate limited, retrying http client
+# one instance is meant to be shared across all the threads of a job
+class HttpClient:
+    def __init__(self, rate: float = 0, max_concurrency: int = 8, retries: int = 4, backoff: float = 0.5, timeout: float = 30, stage: str = "http_fetch"):
+        # rate is in requests per second, 0 disables rate limiting
+        # stage names the request timer and retry count in the run metrics
+        self.stage = stage
+        self.bucket = TokenBucket(rate, max(1, int(rate))) if rate > 0 else None
+        self.max_concurrency = max_concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.retry_count = 0
+        self.failure_count = 0
+        # only the recent latencies are kept for the percentiles, the clients live as long as the scraper daemon
+        self.latencies = deque(maxlen=TIMER_SAMPLES)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if self.bucket:
+                self.bucket.acquire()
+
+            retry_after = None
+            try:
+                with self.slots:
+                    start = time.perf_counter()
+                    try:
+                        response = self._send(method, url, **kwargs)
+                    finally:
+                        self._record(time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = requests.HTTPError(f"{response.status_code} for {url}", response=response)
+                retry_after = response.headers.get("Retry-After")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt >= self.retries:
+                with self.stats_lock:
+                    self.failure_count += 1
+                raise error
+
+            with self.stats_lock:
+                self.retry_count += 1
+            metrics.count(f"{self.stage}_retries")
+            self._sleepBeforeRetry(attempt, retry_after)
+            attempt += 1
+
+    # goes to the fixture archive instead of the network when replaying, and saves responses when recording
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        archive = replay.archive
+        if archive and archive.mode == "replay":
+            return archive.load(method, url, kwargs.get("data"), kwargs.get("params"))
+
+        response = self.session.request(method, url, **kwargs)
+        if archive and response.status_code not in RETRY_STATUSES:
+            archive.save(method, url, response, kwargs.get("data"), kwargs.get("params"))
+        return response
+
+    # full jitter exponential backoff, unless the server told us how long to wait
+    def _sleepBeforeRetry(self, attempt: int, retry_after: str | None):
+        if retry_after and retry_after.isdigit():
+            time.sleep(int(retry_after))
+        else:
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _record(self, latency: float):
+        with self.stats_lock:
+            self.request_count += 1
+            self.latencies.append(latency)
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+        metrics.observe(self.stage, latency)
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            return {
+                "requests": self.request_count,
+                "retries": self.retry_count,
+                "failures": self.failure_count,
+                "latency_avg": self.latency_total / self.request_count if self.request_count else 0,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0,
+                "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0,
+                "latency_max": self.latency_max,
+            }
+
+    def printStats(self, name: str):
+        stats = self.stats()
+        print(
+            f"{name}: {stats['requests']} requests, {stats['retries']} retries, {stats['failures']} failures, "
+            f"latency avg {stats['latency_avg']:.3f}s p50 {stats['latency_p50']:.3f}s p95 {stats['latency_p95']:.3f}s max {stats['latency_max']:.3f}s"
+        )
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,156 @@
+import json, threading, time
+from collections import deque
+from contextlib import contextmanager
+
+# errors of one type are printed this many times per stage, after that they're only counted
+PRINTED_ERRORS = 5
+# recent observations kept per stage for the percentiles, so a long running server or daemon stays bounded
+TIMER_SAMPLES = 1000
+
+
+# one stage's observations: exact count, total and max, percentiles over the last `samples` of them
+class Timer:
+    __slots__ = ("count", "total", "max", "samples")
+
+    def __init__(self, samples: int = TIMER_SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+# per-stage timers, counters and error counts for a scraper or embedding run
+# one registry (`metrics` below) is shared by the whole process
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.errors = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                timer = self.timers[stage] = Timer()
+            timer.add(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def error(self, stage: str, exception: Exception):
+        error_type = type(exception).__name__
+        with self.lock:
+            stage_errors = self.errors.setdefault(stage, {})
+            stage_errors[error_type] = stage_errors.get(error_type, 0) + 1
+            seen = stage_errors[error_type]
+        if seen <= PRINTED_ERRORS:
+            print(f"{stage}: {error_type}: {exception}")
+
+    # raw observations, for handing metrics from a worker process back to the parent
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "timers": {stage: (timer.count, timer.total, timer.max, list(timer.samples)) for stage, timer in self.timers.items()},
+                "counters": dict(self.counters),
+                "errors": {stage: dict(counts) for stage, counts in self.errors.items()},
+            }
+
+    def merge(self, snapshot: dict):
+        with self.lock:
+            for stage, (count, total, longest, samples) in snapshot["timers"].items():
+                timer = self.timers.get(stage)
+                if timer is None:
+                    timer = self.timers[stage] = Timer()
+                timer.count += count
+                timer.total += total
+                timer.max = max(timer.max, longest)
+                timer.samples.extend(samples)
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for stage, counts in snapshot["errors"].items():
+                stage_errors = self.errors.setdefault(stage, {})
+                for error_type, count in counts.items():
+                    stage_errors[error_type] = stage_errors.get(error_type, 0) + count
+
+    def clear(self):
+        with self.lock:
+            self.started = time.time()
+            self.timers = {}
+            self.counters = {}
+            self.errors = {}
+
+    def summary(self) -> dict:
+        with self.lock:
+            stages = {}
+            for stage, timer in self.timers.items():
+                values = sorted(timer.samples)
+                stages[stage] = {
+                    "count": timer.count,
+                    "total": timer.total,
+                    "p50": values[len(values) // 2],
+                    "p95": values[int(len(values) * 0.95)],
+                    "max": timer.max,
+                }
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "stages": stages,
+                "counters": dict(self.counters),
+                "errors": {stage: dict(counts) for stage, counts in self.errors.items()},
+            }
+
+    # prometheus text exposition format
+    def prometheus(self, prefix: str) -> str:
+        summary = self.summary()
+        lines = [
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, stats in summary["stages"].items():
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="0.5"}} {stats["p50"]}')
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="0.95"}} {stats["p95"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stats["total"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in summary["counters"].items():
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+        lines.append(f"# TYPE {prefix}_errors_total counter")
+        for stage, counts in summary["errors"].items():
+            for error_type, value in counts.items():
+                lines.append(f'{prefix}_errors_total{{stage="{stage}",type="{error_type}"}} {value}')
+        lines.append(f"# TYPE {prefix}_run_duration_seconds gauge")
+        lines.append(f"{prefix}_run_duration_seconds {summary['duration']}")
+        return "\n".join(lines) + "\n"
+
+    def printSummary(self):
+        summary = self.summary()
+        for stage, stats in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+            print(f"{stage}: {stats['count']} in {stats['total']:.2f}s, p50 {stats['p50'] * 1000:.1f}ms p95 {stats['p95'] * 1000:.1f}ms")
+        for stage, counts in summary["errors"].items():
+            print(f"{stage} errors: " + ", ".join(f"{count} {error_type}" for error_type, count in counts.items()))
+
+    def export(self, prefix: str, json_path: str | None = None, prometheus_path: str | None = None):
+        if json_path:
+            with open(json_path, "w") as file:
+                json.dump(self.summary(), file, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, "w") as file:
+                file.write(self.prometheus(prefix))
+
+
+metrics = Metrics()
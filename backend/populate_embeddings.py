@@ -1,17 +1,26 @@
-import pickle, json, sys, os, argparse
-from tqdm import trange, tqdm
-import requests
+import os, argparse
+import numpy as np
+import psycopg2
+from typing import Callable
+from tqdm import tqdm
 import concurrent.futures
-from haystack.components.embedders import SentenceTransformersDocumentEmbedder
+from contextlib import closing
 from haystack import Document
 from course import Course
-from haystack.document_stores.in_memory import InMemoryDocumentStore
 from haystack_integrations.document_stores.pgvector import PgvectorDocumentStore
 from haystack.document_stores.types.policy import DuplicatePolicy
 from haystack.utils import Secret
 from dotenv import load_dotenv
-from time import sleep
 from haystack_integrations.components.embedders.google_genai import GoogleGenAIDocumentEmbedder
+from http_client import HttpClient
+from metrics import metrics
+from detail_cache import DetailCache, DETAIL_CACHE_TTL, CLASS_DETAIL_URL
+from replay import useArchive
+from corpus import Corpus, writeCorpus, courseRecords, COURSE_CORPUS_PATH, EMBEDDING_CORPUS_PATH
+from embedding_job import EmbeddingJob, fakeEmbed, EMBEDDING_CHECKPOINT_PATH, EMBED_BATCH_SIZE, EMBED_CONCURRENCY
+
+# shared by the class list and class detail downloads, replaces the old per-thread sleep
+client = HttpClient(rate=20, max_concurrency=10, stage="pisa_fetch")
 
 def termToQuarterName(term : str) -> str:
     match term:
@@ -46,104 +55,179 @@ def termToQuarterName(term : str) -> str:
         case "2222":
             return "Spring 2022"
 
-def populate(term: str = "-1"):
-    terms = ["2258", "2254", "2252", "2250", "2248", "2244", "2242", "2240", "2238", "2234", "2232", "2230", "2228", "2224", "2222"]
+CLASS_LIST_URL = "https://my.ucsc.edu/PSIGW/RESTListeningConnector/PSFT_CSPRD/SCX_CLASS_LIST.v1/"
+
+def fetch_class_list(term: str) -> list[dict]:
+    return client.get(CLASS_LIST_URL+term+"?dept=").json().get('classes', [])
+
+# picks one section to fetch details for per course (subject + catalog_nbr)
+# class_lists is [(term, classes)] newest term first, and each course is taken from the newest term that lists it
+# within a term the lowest class_nbr is used, so the plan doesn't depend on the order PISA lists sections in
+def plan_course_details(class_lists: list[tuple[str, list[dict]]]) -> list[tuple[str, str]]:
+    planned = {}
+    for term, classes in class_lists:
+        term_courses = {}
+        for value in classes:
+            class_nbr = value.get('class_nbr')
+            if class_nbr is None:
+                continue
+            subject = str(value.get('subject') or "").strip()
+            catalog_nbr = str(value.get('catalog_nbr') or "").strip()
+            # sections without a course in the payload are fetched on their own
+            key = (subject, catalog_nbr) if subject and catalog_nbr else (term, str(class_nbr))
+            if key in planned:
+                continue
+            if key not in term_courses or int(class_nbr) < int(term_courses[key]):
+                term_courses[key] = str(class_nbr)
+        for key, class_nbr in term_courses.items():
+            planned[key] = (term, class_nbr)
+    return list(planned.values())
+
+# every term the course corpus is built from, newest first
+TERMS = ["2258", "2254", "2252", "2250", "2248", "2244", "2242", "2240", "2238", "2234", "2232", "2230", "2228", "2224", "2222"]
+
+# use_cache=False fetches every class detail from PISA, e.g. when recording them to a fixture archive
+def populate(term: str = "-1", cache_ttl: int = DETAIL_CACHE_TTL, use_cache: bool = True):
+    terms = TERMS
+    # only the newest two terms can still change
+    detail_cache = DetailCache(ttl=cache_ttl, live_terms=terms[:2]) if use_cache else None
     if term != "-1":
         terms = [term]
     print(f"updating cache with {terms}...")
-    classNums = []
-    addedNums = set()
-    for term in terms:
-        baseUrl = "https://my.ucsc.edu/PSIGW/RESTListeningConnector/PSFT_CSPRD/SCX_CLASS_LIST.v1/"+term+"?dept="
-
-        
-
-        allCourses = requests.get(baseUrl)
-        #print(allCourses.text)
-        for value in allCourses.json().get('classes', []):
 
-            # Access the 'class_nbr' key
-            class_nbr = value.get('class_nbr')
-            if class_nbr not in addedNums:
-                course = (term, str(class_nbr))
-                classNums.append(course)
-                addedNums.add(class_nbr)
+    with concurrent.futures.ThreadPoolExecutor(client.max_concurrency) as executor:
+        class_lists = list(zip(terms, executor.map(fetch_class_list, terms)))
+    sections = sum(len(classes) for _, classes in class_lists)
+    classNums = plan_course_details(class_lists)
+    print(f"{sections} sections listed, fetching details for {len(classNums)} courses")
 
-            
     #print(classNums)
     print("beginning download")
 
-    with concurrent.futures.ThreadPoolExecutor(10) as executor:
-        # Using a set for dupe protection
-        unique_results = set()
-
+    with concurrent.futures.ThreadPoolExecutor(client.max_concurrency) as executor:
         # Define a function to fetch course data
         def fetch_course_data(course_input):
             try:
                 term = course_input[0]
-                baseurl = "https://my.ucsc.edu/PSIGW/RESTListeningConnector/PSFT_CSPRD/SCX_CLASS_DETAIL.v1/" + term + "/"
-                raw = requests.get(baseurl + course_input[1], timeout=30).json()
+                if detail_cache:
+                    raw = detail_cache.fetch(client, term, course_input[1])
+                else:
+                    raw = client.get(CLASS_DETAIL_URL + f"{term}/{course_input[1]}").json()
                 detailedCourse = raw.get('primary_section')
 
-                # Dupe/ratelimit protection
-                courseName = detailedCourse.get('subject')+detailedCourse.get('catalog_nbr')
-                sleep(0.1)
-                if (courseName) not in unique_results:
-                    unique_results.add(courseName)
-                    course = Course(
-                        termToQuarterName(detailedCourse.get('strm')),
-                        detailedCourse.get('acad_career'),
-                        detailedCourse.get('subject'),
-                        detailedCourse.get('catalog_nbr'),
-                        detailedCourse.get('title_long'),
-                        detailedCourse.get('description'),
-                        detailedCourse.get('gened'),
-                        detailedCourse.get('requirements'),
-                        raw.get('notes'),
-                    ).to_dict()
-                    return course
+                return Course(
+                    termToQuarterName(detailedCourse.get('strm')),
+                    detailedCourse.get('acad_career'),
+                    detailedCourse.get('subject'),
+                    detailedCourse.get('catalog_nbr'),
+                    detailedCourse.get('title_long'),
+                    detailedCourse.get('description'),
+                    detailedCourse.get('gened'),
+                    detailedCourse.get('requirements'),
+                    raw.get('notes'),
+                )
             except Exception as e:
-                print(f"Error fetching {course_input}: {str(e)}")
+                metrics.error("detail_fetch", e)
                 return None
 
-        # Use tqdm for the progress bar
+        # Use tqdm for the progress bar, map keeps the results in plan order
         results = list(tqdm(executor.map(fetch_course_data, classNums), total=len(classNums)))
 
     detailedInfo = list(filter(None, results))
+    client.printStats("class detail api")
+    if detail_cache:
+        detail_cache.printStats("class detail cache")
 
     #detailedInfo.extend(result[-1] for result in results)
     print("array created")
     #print(detailedInfo)
 
-    picklefile = open("cache/updatedclasses", mode="wb")
-    pickle.dump(detailedInfo, picklefile)
-    picklefile.close()    
-
-
-    jsonfile = open("cache/updatedclasses.json", mode="w")
-    json.dump(detailedInfo, jsonfile)
-    jsonfile.close()
-
-
-def populate_embeddings(documents: list[Document]):
-    print("updating embeddings...")
+    writeCorpus(COURSE_CORPUS_PATH, courseRecords(detailedInfo), terms=terms)
+
+
+def load_course_records() -> list[dict]:
+    corpus = Corpus(COURSE_CORPUS_PATH)
+    records = list(corpus)
+    corpus.close()
+    return records
+
+# stored embeddings of courses missing from the course corpus are only pruned if the corpus was built from
+# every term, a corpus from -t (or one from before the terms were recorded) only holds some of the courses
+def corpus_has_all_terms() -> bool:
+    corpus = Corpus(COURSE_CORPUS_PATH)
+    terms = corpus.terms
+    corpus.close()
+    if terms is None or not set(TERMS) <= set(terms):
+        print(f"course corpus was built from {terms or 'unrecorded terms'}, not pruning embeddings of courses missing from it")
+        return False
+    return True
+
+def build_documents(records: list[dict]) -> list[Document]:
+    return [
+        Document(id=record["id"], content=str(record["course"]), meta={"content_hash": record["content_hash"]})
+        for record in records
+    ]
+
+# returns (documents that are new or changed, ids of stored documents for courses that no longer exist)
+# stored_hashes maps document id to content hash for everything already embedded
+def plan_embeddings(documents: list[Document], stored_hashes: dict[str, str]) -> tuple[list[Document], list[str]]:
+    changed = [document for document in documents if stored_hashes.get(document.id) != document.meta["content_hash"]]
+    current_ids = {document.id for document in documents}
+    deleted = [id for id in stored_hashes if id not in current_ids]
+    print(f"{len(changed)} new or changed documents, {len(documents) - len(changed)} unchanged, {len(deleted)} removed")
+    return changed, deleted
+
+def gemini_embedder() -> Callable[[list[Document]], list[Document]]:
     # embeddings_model = os.getenv("EMBEDDINGS_MODEL")
     # document_embedder = SentenceTransformersDocumentEmbedder(model=embeddings_model)
     # document_embedder.warm_up()
     document_embedder = GoogleGenAIDocumentEmbedder(api_key=Secret.from_env_var("GEMINI_KEY"))
-    documents_with_embeddings = document_embedder.run(documents)
-    picklefile = open("cache/classembeddings", mode="wb")
-    pickle.dump(documents_with_embeddings, picklefile)
-    picklefile.close()
-
-def populate_pgvector_embeddings(documents: list[Document]):
+    return lambda documents: document_embedder.run(documents)["documents"]
+
+# only the id and hash of each stored document, so the embeddings themselves aren't loaded
+# the store creates its table on first use, so it's used once before the table is read directly
+def stored_pgvector_hashes(document_store: PgvectorDocumentStore) -> dict[str, str]:
+    document_store.count_documents()
+    # the connection's with block only ends the transaction, closing() closes it
+    with closing(psycopg2.connect(os.environ.get("PG_CONN_STRING"))) as conn, conn, conn.cursor() as cur:
+        try:
+            cur.execute(f"SELECT id, meta->>'content_hash' FROM \"{document_store.table_name}\"")
+        except psycopg2.errors.UndefinedTable:
+            return {}
+        return dict(cur.fetchall())
+
+# prune=False keeps stored documents missing from `records`, for caches that only hold some terms
+# by default they're pruned only if the course corpus covers every term
+def populate_embeddings(records: list[dict], job: EmbeddingJob, prune: bool | None = None):
+    print("updating embeddings...")
+    if prune is None:
+        prune = corpus_has_all_terms()
+    previous = Corpus(EMBEDDING_CORPUS_PATH) if Corpus.exists(EMBEDDING_CORPUS_PATH) else None
+
+    changed, deleted = plan_embeddings(build_documents(records), previous.contentHashes() if previous else {})
+    embedded = {document.id: document.embedding for document in job.run(changed)}
+
+    # unchanged rows are copied straight out of the old mapped matrix
+    rows = []
+    vectors = []
+    for record in records:
+        rows.append(record)
+        vectors.append(embedded[record["id"]] if record["id"] in embedded else previous.embedding(previous.row(record["id"])))
+    if not prune:
+        for id in deleted:
+            row = previous.row(id)
+            rows.append(previous.record(row))
+            vectors.append(previous.embedding(row))
+
+    writeCorpus(EMBEDDING_CORPUS_PATH, rows, np.array(vectors, dtype=np.float32))
+    if previous:
+        previous.close()
+    job.clear()
+
+def populate_pgvector_embeddings(records: list[dict], job: EmbeddingJob, prune: bool | None = None):
     print("updating pgvector documents and embeddings...")
-    # embeddings_model = os.getenv("EMBEDDINGS_MODEL")
-    # document_embedder = SentenceTransformersDocumentEmbedder(model=embeddings_model)
-    # document_embedder.warm_up()
-    document_embedder = GoogleGenAIDocumentEmbedder(api_key=Secret.from_env_var("GEMINI_KEY"))
-    embeddings = document_embedder.run(documents)
-    
+    if prune is None:
+        prune = corpus_has_all_terms()
     document_store = PgvectorDocumentStore(
         connection_string = Secret.from_env_var("PG_CONN_STRING"),
         embedding_dimension=768,
@@ -152,8 +236,18 @@ def populate_pgvector_embeddings(documents: list[Document]):
         search_strategy="hnsw",
     )
 
-    document_store.write_documents(documents, policy=DuplicatePolicy.OVERWRITE)
-    document_store.write_documents(embeddings['documents'], policy=DuplicatePolicy.OVERWRITE)
+    changed, deleted = plan_embeddings(build_documents(records), stored_pgvector_hashes(document_store))
+    embedded = job.run(changed)
+
+    # each changed document is written once, together with its embedding
+    with metrics.time("upsert"):
+        if embedded:
+            document_store.write_documents(embedded, policy=DuplicatePolicy.OVERWRITE)
+        if deleted and prune:
+            document_store.delete_documents(deleted)
+    if prune:
+        metrics.count("documents_removed", len(deleted))
+    job.clear()
 
 
 if __name__ == "__main__":
@@ -163,15 +257,32 @@ if __name__ == "__main__":
                 description='Generates course embeddings for LLM backend'
             )
     
-    parser.add_argument("-c", "--cache", action='store_true', help='store course data in pickle cache')
-    parser.add_argument("-l", "--local-embed", action='store_true', help='generate embeddings from pickle cache and store locally')
-    parser.add_argument("-p", "--pgvector-embed", action='store_true', help='generate embeddings from pickle cache and store in pgvector database (requires local pickle cache)')
+    parser.add_argument("-c", "--cache", action='store_true', help='store course data in the course corpus (cache/courses)')
+    parser.add_argument("-l", "--local-embed", action='store_true', help='generate embeddings from the course corpus and store them locally (cache/class_embeddings)')
+    parser.add_argument("-p", "--pgvector-embed", action='store_true', help='generate embeddings from the course corpus and store in pgvector database (requires the course corpus)')
 
     parser.add_argument("-t", "--term", type=int, default=None, help='pick a specific term to scrape')
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE, help='documents per embedding request')
+    parser.add_argument("--embed-concurrency", type=int, default=EMBED_CONCURRENCY, help='embedding requests in flight at once')
+    parser.add_argument("--checkpoint", default=EMBEDDING_CHECKPOINT_PATH, help='file finished embedding batches are saved to, an interrupted run resumes from it')
+    parser.add_argument("--fake-embed", action='store_true', help='use deterministic fake embeddings instead of gemini, for testing the pipeline locally')
+    parser.add_argument("--no-prune", action='store_true', help='keep stored embeddings for courses missing from the cache (automatic when the cache was built with -t)')
+    parser.add_argument("--cache-ttl", type=int, default=DETAIL_CACHE_TTL, help='seconds before cached class details for the newest terms are refetched')
+
+    parser.add_argument("--record", metavar="ARCHIVE", help='save every PISA response to a fixture archive (skips the class detail cache, so every response is recorded)')
+    parser.add_argument("--replay", metavar="ARCHIVE", help='serve PISA responses from a fixture archive instead of the network (skips the class detail cache)')
+    parser.add_argument("--replay-latency", type=float, default=0, help='seconds of latency to add to each replayed response')
+    parser.add_argument("--metrics-json", metavar="PATH", help='write a JSON summary of per-stage timings, counters and errors')
+    parser.add_argument("--metrics-prom", metavar="PATH", help='write the run metrics in Prometheus text format')
 
     args = parser.parse_args()
     load_dotenv()
 
+    if args.record:
+        useArchive(args.record, "record")
+    elif args.replay:
+        useArchive(args.replay, "replay", args.replay_latency)
+
     if not args.cache and not args.local_embed and not args.pgvector_embed:
         parser.print_help()
         parser.exit()
@@ -180,35 +291,24 @@ if __name__ == "__main__":
         print("term not valid")
         parser.exit()
 
+    # only runs that embed need the embedder (and its api key)
+    job = None
+    if args.local_embed or args.pgvector_embed:
+        embed = fakeEmbed if args.fake_embed else gemini_embedder()
+        job = EmbeddingJob(embed, args.checkpoint, args.embed_batch_size, args.embed_concurrency)
+
     if args.cache:
         if args.term:
-            populate(str(args.term))
+            populate(str(args.term), args.cache_ttl, not (args.record or args.replay))
         else:
-            populate()
+            populate(cache_ttl=args.cache_ttl, use_cache=not (args.record or args.replay))
     
     if args.local_embed:
-        file = open("cache/updatedclasses", mode="rb")
-        detailed_info = pickle.load(file)
-        file.close()
-
-        # Write documents to InMemoryDocumentStore  
-        document_store = InMemoryDocumentStore()
-        documents = []
-        for i in detailed_info:
-            documents.append(Document(content=str(i)))
-
-        document_store.write_documents(documents)
-
-        doc_picklefile = open("cache/classdocuments", mode="wb")
-        pickle.dump(document_store, doc_picklefile)
-        
-        populate_embeddings(documents)
+        populate_embeddings(load_course_records(), job, False if args.no_prune else None)
     
     if args.pgvector_embed:
-        with open("cache/updatedclasses", "rb") as file:
-            detailed_info = pickle.load(file)
+        populate_pgvector_embeddings(load_course_records(), job, False if args.no_prune else None)
 
-        documents = [Document(content=str(item)) for item in detailed_info]
-        # print(documents)
-        populate_pgvector_embeddings(documents)
+    metrics.printSummary()
+    metrics.export("embeddings", args.metrics_json, args.metrics_prom)
 
@@ -1,15 +1,30 @@
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from tqdm import tqdm
-import os, json, re
+from bulk_writer import createWriter, BATCH_SIZE, WRITE_CONCURRENCY
+from course import GradeDistribution
+from grade_aggregates import GradeLedger, AGGREGATES_TABLE_SQL
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterator, TextIO
+import os, json, re, argparse
+import psycopg2
 
+# characters of the grades file read at a time
+READ_CHUNK = 1 << 16
+COURSE_NUMBER = re.compile(r'(\d+)(\D*)')
+# between array elements
+SEPARATORS = " \t\r\n,"
+
+# instructor names repeat across thousands of rows, so each one is only formatted once
+@lru_cache(maxsize=None)
 def format_name(full_name: str):
     """
     Convert full name (e.g. 'Caroline Brett Casey') to format 'Casey,C.B.'
-    
+
     Args:
         full_name (str): Full name with optional middle name(s)
-        
+
     Returns:
         str: Formatted name with last name, first and middle initials
     """
@@ -18,53 +33,153 @@ def format_name(full_name: str):
     initials = '.'.join(part[0] for part in name_parts[:-1])
     return f"{last_name},{initials}."
 
+# grade label to column name, e.g. A+ to a_plus
+@lru_cache(maxsize=None)
+def grade_column(key: str) -> str:
+    return key.lower().replace("+", "_plus").replace("-", "_minus")
+
+def iter_json_array(file: TextIO, chunk_size: int = READ_CHUNK) -> Iterator:
+    """
+    Yield the elements of a top level JSON array one at a time, reading the file in chunks.
+
+    Only the current chunk and the element being decoded are held in memory, whatever the size of the file.
+    Elements are expected to be objects or arrays, a number cut off at the end of a chunk would be misread.
+    """
+    decoder = json.JSONDecoder()
+    # leading whitespace can run past the first chunk
+    buffer = ""
+    while not buffer:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        buffer = chunk.lstrip()
+    if not buffer.startswith("["):
+        raise ValueError(f"{getattr(file, 'name', 'input')} is not a JSON array")
+    position = 1
+
+    while True:
+        while True:
+            while position < len(buffer) and buffer[position] in SEPARATORS:
+                position += 1
+            if position < len(buffer):
+                break
+            buffer = file.read(chunk_size)
+            position = 0
+            if not buffer:
+                raise ValueError("unexpected end of JSON array")
+        if buffer[position] == "]":
+            return
+
+        while True:
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError:
+                # the element continues in the next chunk
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+        yield element
+
+def transform_grade(grade: dict) -> GradeDistribution:
+    dept_number = grade["class"].split(" ")
+    full_course_number = dept_number[1]
+    course_number = full_course_number
+    course_letter = ""
+
+    course_match = COURSE_NUMBER.match(full_course_number)
+    if course_match:
+        course_number = course_match.group(1)
+        course_letter = course_match.group(2)
+
+    names = [format_name(name) for name in grade["instructors"]]
+    return GradeDistribution(
+        term=str(grade["termCode"]),
+        department=dept_number[0],
+        course_number=course_number,
+        course_letter=course_letter,
+        short_name=grade["title"],
+        # join names in reverse order, since that's how pisa does it
+        instructor=", ".join(names[::-1]),
+        counts={grade_column(key): count for key, count in grade["gradeCounts"].items() if key != "-"},
+    )
+
+def ingest_file(path: str, copy: bool = False, batch_size: int = BATCH_SIZE, write_concurrency: int = WRITE_CONCURRENCY, position: int = 0) -> int:
+    """
+    Stream one grades dump into the grades table, upserting rows in batches as they're parsed.
+    Written rows are recorded in the grade ledger, so the aggregates they feed get refreshed afterwards.
+
+    Runs in a worker process when several files are given, so it sets up its own database client.
+    Returns the number of rows written.
+    """
+    load_dotenv()
+    supabase: Client = create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
+    writer = createWriter(supabase, "grades", copy, batch_size, write_concurrency)
+    ledger = GradeLedger()
+
+    # enough rows per upsert to keep every write slot busy
+    flush_size = batch_size * write_concurrency
+    rows = []
+    count = 0
+
+    def flush():
+        nonlocal count, rows
+        count += writer.upsert(rows)
+        # recorded after the write, so aggregates never include rows that aren't in the grades table
+        ledger.record(rows)
+        rows = []
+
+    with open(path, 'r', encoding='utf-8') as grades_file:
+        for grade in tqdm(iter_json_array(grades_file), desc=os.path.basename(path), unit="grade", position=position):
+            rows.append(transform_grade(grade))
+            if len(rows) >= flush_size:
+                flush()
+    flush()
+    writer.close()
+    ledger.close()
+    return count
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process and upsert grade distributions.")
+    parser.add_argument("files", nargs="*", default=["./grades.json"], help="Grade dumps to ingest (default: ./grades.json).")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Files ingested at once, each in its own process.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows per upsert request.")
+    parser.add_argument("--write-concurrency", type=int, default=WRITE_CONCURRENCY, help="Upsert requests in flight at once, per file.")
+    parser.add_argument("--copy", action="store_true", help="Write directly to postgres (SUPABASE_CONN_STRING) with COPY instead of the supabase api.")
+    parser.add_argument("--no-aggregates", action="store_true", help="Don't refresh the grade_aggregates table after ingesting.")
+    parser.add_argument("--rebuild-aggregates", action="store_true", help="Recompute every aggregate from the grades table, not just the ones new grades changed.")
+    parser.add_argument("--aggregates-sql", action="store_true", help="Print the CREATE TABLE statement for grade_aggregates and exit.")
+    args = parser.parse_args()
+
+    if args.aggregates_sql:
+        print(AGGREGATES_TABLE_SQL)
+        parser.exit()
+
+    # aggregates are computed from the grades table itself, which takes a direct database connection
     load_dotenv()
-    url: str = os.environ.get("SUPABASE_URL")
-    key: str = os.environ.get("SUPABASE_KEY")
-    supabase: Client = create_client(url, key)
-    # print(supabase)
-
-    with open('./grades.json', 'r') as grades_file:
-        grades = json.load(grades_file)
-    
-    # print(grades)
-
-    processed_grades = []
-    grade_map = {}
-    for grade in tqdm(grades, desc="Processing Grades", unit="grade"):
-        # print(grade["gradeCounts"])
-        dept_number = grade["class"].split(" ")
-        # last_names = [name.split()[-1] for name in grade["instructors"]]
-
-        names = [format_name(name) for name in grade["instructors"]]
-
-
-        full_course_number = dept_number[1]
-        course_number = full_course_number
-
-        course_match = re.match(r'(\d+)(\D*)', full_course_number)
-        course_letter = ""
-
-        if course_match:
-            course_number = course_match.group(1)
-            course_letter = course_match.group(2)
-        
-        processed_grade = {
-            "term": str(grade["termCode"]),
-            "department": dept_number[0],
-            "course_number": course_number,
-            "course_letter": course_letter,
-            "short_name": grade["title"],
-            # join names in reverse order, since that's how pisa does it
-            "instructor": ", ".join(names[::-1]),
-        }
-        for key in grade["gradeCounts"].keys():
-            if key != "-":
-                if key not in grade_map:
-                    grade_map[key] = key.lower().replace("+", "_plus").replace("-", "_minus")
-                processed_grade[grade_map[key]] = grade["gradeCounts"][key]
-        # print(processed_grade)
-        processed_grades.append(processed_grade)
-        # print(processed_grade)
-    supabase.table("grades").upsert(processed_grades).execute()
+    if not args.no_aggregates and not os.environ.get("SUPABASE_CONN_STRING"):
+        parser.error("refreshing aggregates needs SUPABASE_CONN_STRING (or pass --no-aggregates)")
+
+    workers = min(args.workers, len(args.files))
+    if workers <= 1:
+        total = sum(ingest_file(path, args.copy, args.batch_size, args.write_concurrency) for path in args.files)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(ingest_file, path, args.copy, args.batch_size, args.write_concurrency, position)
+                for position, path in enumerate(args.files)
+            ]
+            total = sum(future.result() for future in futures)
+    print(f"ingested {total} grade rows from {len(args.files)} files")
+
+    if not args.no_aggregates:
+        ledger = GradeLedger()
+        supabase: Client = create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
+        aggregate_writer = createWriter(supabase, "grade_aggregates", args.copy, args.batch_size, args.write_concurrency)
+        with psycopg2.connect(os.environ.get("SUPABASE_CONN_STRING")) as grades_conn:
+            print(f"refreshed {ledger.refresh(aggregate_writer, grades_conn, args.rebuild_aggregates)} grade aggregates")
+        grades_conn.close()
+        aggregate_writer.close()
+        ledger.close()
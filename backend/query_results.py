@@ -0,0 +1,75 @@
+import psycopg2
+from metrics import metrics
+
+# most rows of a query result sent back to the model
+RESULT_MAX_ROWS = 100
+# characters of result text sent back to the model, roughly four to a token
+RESULT_MAX_CHARS = 24000
+# text values (descriptions, requirements, notes) are cut to this length when a result is over budget
+TEXT_FIELD_LIMIT = 300
+# rows fetched from the server-side cursor per round trip
+FETCH_SIZE = 200
+# columns that identify a course, for counting the distinct courses in a capped result
+COURSE_COLUMNS = ("department", "course_number", "course_letter")
+
+def truncateText(value, limit: int):
+    if isinstance(value, str) and len(value) > limit:
+        return value[:limit] + "..."
+    return value
+
+# row count and distinct courses of the whole result, for when only part of it is returned
+# runs the query again as a subquery, a query that can't be wrapped just gets no summary
+def summarizeResult(conn, sql: str, columns: list[str]) -> dict:
+    aggregates = ["count(*)"]
+    if "department" in columns and "course_number" in columns:
+        aggregates.append(f"count(DISTINCT ({', '.join(column for column in COURSE_COLUMNS if column in columns)}))")
+    try:
+        with conn.cursor() as cur:
+            # the newline ends a trailing line comment in the query before the subquery is closed
+            cur.execute(f"SELECT {', '.join(aggregates)} FROM ({sql}\n) AS results")
+            counts = cur.fetchone()
+    except psycopg2.Error as e:
+        metrics.error("sql_summary", e)
+        return {}
+    summary = {"total_rows": counts[0]}
+    if len(counts) > 1:
+        summary["distinct_courses"] = counts[1]
+    return summary
+
+# runs a query through a server-side cursor and shapes the result to fit the model's context
+# only max_rows + 1 rows are ever pulled from the database. if the rows are over max_chars, long text values
+# are cut to text_limit, and if that isn't enough, rows are dropped from the end
+# results that fit are returned as the list of rows, capped ones as a dict with the rows kept and a summary
+def fetchBounded(conn, sql: str, max_rows: int = RESULT_MAX_ROWS, max_chars: int = RESULT_MAX_CHARS, text_limit: int = TEXT_FIELD_LIMIT) -> list | dict:
+    # named cursors need a transaction, which pooled connections are always in
+    with conn.cursor(name="bounded_result") as cur:
+        cur.itersize = FETCH_SIZE
+        cur.execute(sql)
+        rows = cur.fetchmany(max_rows + 1)
+        columns = [column.name for column in cur.description]
+
+    capped = len(rows) > max_rows
+    rows = rows[:max_rows]
+    if len(str(rows)) > max_chars:
+        rows = [tuple(truncateText(value, text_limit) for value in row) for row in rows]
+        metrics.count("sql_results_truncated")
+
+    # each row adds its text plus the ", " separating it from the next
+    used = 2
+    for kept, row in enumerate(rows):
+        used += len(str(row)) + 2
+        if used > max_chars:
+            rows = rows[:kept]
+            capped = True
+            break
+
+    if not capped:
+        return rows
+    metrics.count("sql_results_capped")
+    return {
+        "rows": rows,
+        "columns": columns,
+        "rows_returned": len(rows),
+        **summarizeResult(conn, sql, columns),
+        "note": "The result was too large and only its first rows are included. Narrow the query (specific columns, quarter, course) to see the rest.",
+    }
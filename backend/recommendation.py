@@ -1,11 +1,12 @@
-import os, psycopg2, json
+import os, psycopg2, json, time
+from concurrent.futures import ThreadPoolExecutor
 #from haystack import Pipeline
 from haystack.components.joiners.document_joiner import DocumentJoiner
 from haystack.components.embedders import SentenceTransformersTextEmbedder
 from haystack.components.builders.prompt_builder import PromptBuilder
 from dotenv import load_dotenv
 from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from google import genai
 from google.genai import types
 from pydantic import BaseModel
@@ -17,6 +18,13 @@ from haystack.utils import Secret
 from haystack.components.rankers import TransformersSimilarityRanker, SentenceTransformersSimilarityRanker
 from fastapi.middleware.cors import CORSMiddleware
 from haystack_integrations.components.embedders.google_genai import GoogleGenAIDocumentEmbedder, GoogleGenAITextEmbedder
+from db_pool import ConnectionPool, PoolTimeout, withStatementTimeout, POOL_MAX_SIZE, STATEMENT_TIMEOUT_MS
+from metrics import metrics
+from data_version import DataVersions
+from result_cache import ResultCache, normalizeSql
+from query_results import fetchBounded
+from embedding_cache import QueryEmbeddingCache, QUERY_EMBEDDING_CACHE_PATH
+import threading
 
 # create app and load .env
 classRecommender = FastAPI(
@@ -42,6 +50,18 @@ GEMINI_KEY = os.getenv("GEMINI_KEY")
 PG_CONN_STRING = os.getenv("PG_CONN_STRING")
 SUPABASE_CONN_STRING = os.getenv("SUPABASE_CONN_STRING")
 
+# read-only connections for retrieve_specific, shared by every chat request instead of connecting per tool call
+# opened on first use, so the server still starts if the database is unreachable
+sql_pool = ConnectionPool(
+    SUPABASE_CONN_STRING,
+    min_size=0,
+    max_size=int(os.getenv("SQL_POOL_SIZE") or POOL_MAX_SIZE),
+    statement_timeout_ms=int(os.getenv("SQL_STATEMENT_TIMEOUT_MS") or STATEMENT_TIMEOUT_MS),
+)
+# the model repeats the same queries a lot, results are reused until the scraper bumps the terms they came from
+data_versions = DataVersions(sql_pool)
+result_cache = ResultCache()
+
 prompt_template = '''
 Given these documents, answer the question. 
 Assume the user is an undergraduate student and cannot take graduate classes without instructor permission.
@@ -61,9 +81,27 @@ Answer:'''
 # 6) Insert merged document list and user input into prompt
 # 7) Query LLM and return response. 
 
+# seconds each search branch gets, counted from the start of the search. the vector branch includes the embedding call
+KEYWORD_TIMEOUT = float(os.getenv("KEYWORD_TIMEOUT") or 5)
+VECTOR_TIMEOUT = float(os.getenv("VECTOR_TIMEOUT") or 10)
+
+# the stores' sessions time out with their branch, so a search nobody waits for anymore is cancelled by the
+# database instead of holding a retrieval thread
+def store_connection(timeout: float) -> Secret:
+    if not PG_CONN_STRING:
+        return Secret.from_env_var("PG_CONN_STRING")
+    return Secret.from_token(withStatementTimeout(PG_CONN_STRING, timeout * 1000))
+
 # (1) intialize store
 document_store = PgvectorDocumentStore(
-    connection_string = Secret.from_env_var("PG_CONN_STRING"),
+    connection_string = store_connection(VECTOR_TIMEOUT),
+    embedding_dimension=768,
+    vector_function="cosine_similarity",
+    search_strategy="hnsw",
+)
+# the keyword search gets its own store, a store's queries share one connection and would run one at a time
+keyword_document_store = PgvectorDocumentStore(
+    connection_string = store_connection(KEYWORD_TIMEOUT),
     embedding_dimension=768,
     vector_function="cosine_similarity",
     search_strategy="hnsw",
@@ -79,9 +117,15 @@ document_store = PgvectorDocumentStore(
 # text_embedder.warm_up()
 
 text_embedder = GoogleGenAITextEmbedder(api_key=Secret.from_env_var("GEMINI_KEY"))
+# repeated queries skip the embedding api, set QUERY_EMBEDDING_CACHE empty to keep them in memory only
+query_embeddings = QueryEmbeddingCache(
+    lambda text: text_embedder.run(text)["embedding"],
+    os.getenv("QUERY_EMBEDDING_CACHE", QUERY_EMBEDDING_CACHE_PATH) or None,
+    namespace=text_embedder.to_dict()["init_parameters"].get("model", ""),
+)
 
 # create retrievers
-keyword_retriever = PgvectorKeywordRetriever(document_store=document_store)
+keyword_retriever = PgvectorKeywordRetriever(document_store=keyword_document_store)
 embedding_retriever = PgvectorEmbeddingRetriever(document_store=document_store)
 
 # create document joiner using reciprocal rank fusion method
@@ -92,6 +136,37 @@ document_ranker = TransformersSimilarityRanker("BAAI/bge-reranker-v2-m3")
 document_ranker.warm_up()
 
 
+# keyword search and embedding + vector search don't depend on each other, so they run side by side
+# chat requests run in starlette's thread pool, at most 40 at once by default, each with one search at a time,
+# so there are two workers per request. a branch that timed out is cancelled by its statement timeout soon
+# after, so abandoned searches can't pile up and take the workers new requests need
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY") or 40)
+retrieval_executor = ThreadPoolExecutor(max_workers=2 * CHAT_CONCURRENCY)
+
+def keyword_search(input: str):
+    return keyword_retriever.run(query=input)["documents"]
+
+def vector_search(input: str):
+    # generate text embeddings based on user input, cached for repeated queries
+    return embedding_retriever.run(query_embedding=query_embeddings.get(input))["documents"]
+
+# (3) + (4) both searches at once, returns the document lists of the branches that finished in time
+# a branch that's slow or fails is left out, so the joiner works from the other one alone
+def retrieve_documents(input: str) -> list[list]:
+    start = time.monotonic()
+    branches = [
+        ("keyword", retrieval_executor.submit(keyword_search, input), KEYWORD_TIMEOUT),
+        ("vector", retrieval_executor.submit(vector_search, input), VECTOR_TIMEOUT),
+    ]
+    results = []
+    for name, future, timeout in branches:
+        try:
+            results.append(future.result(timeout=max(0, start + timeout - time.monotonic())))
+        except Exception as e:
+            # a timed out branch keeps running in the background, its result is just not waited for
+            metrics.error(f"{name}_search", e)
+    return results
+
 # instantiate llm tools
 def retrieve_general(input: str):
     """
@@ -103,17 +178,13 @@ def retrieve_general(input: str):
     - "Tell me about art history classes"
     - "Which courses cover environmental sustainability?"
     """
-    # (2) generate text embeddings based on user input
-    text_embeddings = text_embedder.run(input)
-
-    # (3) keyword based document search
-    keyword_docs = keyword_retriever.run(query=input)
-
-    # (4) create embeddings for vector based document search
-    embedding_docs = embedding_retriever.run(query_embedding=text_embeddings['embedding'])
+    # (2) - (4) keyword based and vector based document search, concurrently
+    document_lists = retrieve_documents(input)
+    if not document_lists:
+        return "Course search is unavailable right now. Try again, or use retrieve_specific."
 
     # (5) merge vector-based docs and keyword-based docs, then rerank
-    merged_docs = document_joiner.run([keyword_docs["documents"], embedding_docs["documents"]])
+    merged_docs = document_joiner.run(document_lists)
     ranked_docs = document_ranker.run(query = input, documents = merged_docs["documents"], top_k = 7)
 
     print(ranked_docs)
@@ -153,6 +224,7 @@ def retrieve_specific(sql_input: str):
     6. "Describe all BME courses in detail."
        SQL: SELECT * FROM llm_view WHERE department = 'BME'
 
+    Large results are cut to their first rows with a row count, so select only the columns you need.
 
     Table: llm_view
     quarter	        The quarter a course is taught.
@@ -180,10 +252,6 @@ def retrieve_specific(sql_input: str):
     if not sql_input or sql_input is None or sql_input == "" or sql_input == "None":
         return "Function requires an input"
 
-    conn = psycopg2.connect(SUPABASE_CONN_STRING)
-    conn.set_session(readonly=True)
-
-    cur = conn.cursor()
     # sanitize input
     sql_input = sql_input.replace("\"","'").replace("\\","").replace("\'","'")
     # why does this happen?
@@ -194,14 +262,27 @@ def retrieve_specific(sql_input: str):
         sql_input+=" ORDER BY term DESC, department ASC, course_number ASC, course_LETTER ASC, section_number ASC"
     # print("executing: "+sql_input)
 
+    # the query runs as written, only the cache key is normalized
+    cache_key = normalizeSql(sql_input)
+    versions = data_versions.current()
+    output = result_cache.get(cache_key, versions)
+    if output is not None:
+        print(f"cached: {output}")
+        return output
+
     try:
-        cur.execute(sql_input)
+        with sql_pool.connection() as conn:
+            output = fetchBounded(conn, sql_input)
+    except PoolTimeout as e:
+        print(f"Database busy: {e}")
+        return "The course database is busy, try again shortly"
     except psycopg2.Error as e:
+        # includes statements cancelled by the statement timeout, the model gets the error to fix its query
         print (f"Database error: {e}")
+        return f"Database error: {e}"
 
-    output = cur.fetchall()
+    result_cache.put(cache_key, versions, output)
     print(f"retrieved: {output}")
-    cur.close()
 
     return output
 
@@ -373,30 +454,46 @@ def get_stream_history(chat: Chat):
 
     return StreamingResponse(stream_data())
 
+# request metrics and connection pool state, in prometheus text format
+@classRecommender.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.prometheus("recommendation") + sql_pool.prometheus("recommendation_sql_pool")
+
+# embeds the suggested questions in the background, so the server doesn't wait on the embedding api to start
+@classRecommender.on_event("startup")
+def warm_query_embeddings():
+    threading.Thread(target=query_embeddings.warm, args=(SUGGESTED_MESSAGES,), daemon=True).start()
+
+@classRecommender.on_event("shutdown")
+def close_pool():
+    sql_pool.close()
+    query_embeddings.close()
+
 # suggestions for chat screen
 import random
+SUGGESTED_MESSAGES = [
+    "Courses that fulfill the IM gen ed",
+    "Courses taught by Prof. Tantalo this quarter",
+    "Open CSE courses this winter",
+    "Is CSE 115a still open this winter?",
+    "How many people are currently enrolled in CSE 130?",
+    "Which professors are teaching CSE 30 in Winter 2025?",
+    "What are the prerequisites for CSE 101?",
+    "What time is ECON 1 held?",
+    "Who teaches ECE 101?",
+    "What are the prerequisites for LING 50?",
+    "What is LING 80K?",
+    "MATH 100 course description",
+    "Courses about ethics",
+    "List all quarters PHIL 9 was taught.",
+    "List all professors for JRLC 1.",
+    "Find artificial intelligence courses",
+    "Show available online courses for the current quarter."
+]
+
 @classRecommender.get("/suggestions")
 def get_suggestions():
-    suggested_messages = [
-        "Courses that fulfill the IM gen ed",
-        "Courses taught by Prof. Tantalo this quarter",
-        "Open CSE courses this winter",
-        "Is CSE 115a still open this winter?",
-        "How many people are currently enrolled in CSE 130?",
-        "Which professors are teaching CSE 30 in Winter 2025?",
-        "What are the prerequisites for CSE 101?",
-        "What time is ECON 1 held?",
-        "Who teaches ECE 101?",
-        "What are the prerequisites for LING 50?",
-        "What is LING 80K?",
-        "MATH 100 course description",
-        "Courses about ethics",
-        "List all quarters PHIL 9 was taught.",
-        "List all professors for JRLC 1.",
-        "Find artificial intelligence courses",
-        "Show available online courses for the current quarter."
-    ]
-    return suggested_messages
+    return SUGGESTED_MESSAGES
 
 #old endpoint (injects documents into prompt directly, only general search)
 # @classRecommender.get("/")
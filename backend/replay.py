@@ -0,0 +1,83 @@
+import atexit, hashlib, json, os, threading, time, zipfile
+from urllib.parse import urlencode
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# fixture archive of recorded http responses, used to run the scraper and embedding jobs without a network
+# each response is stored in a zip file as <key>.json (request and response metadata) and <key>.body
+class FixtureArchive:
+    def __init__(self, path: str, mode: str, latency: float = 0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown archive mode {mode}")
+        self.path = path
+        self.mode = mode
+        # seconds added to every replayed response, to simulate a real server
+        self.latency = latency
+        self.lock = threading.Lock()
+        if mode == "record":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.zip = zipfile.ZipFile(path, "a", compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.zip = zipfile.ZipFile(path, "r")
+        self.names = set(self.zip.namelist())
+
+    @staticmethod
+    def key(method: str, url: str, data: dict | None = None, params: dict | None = None) -> str:
+        request = f"{method.upper()} {url}"
+        if params:
+            request += "?" + urlencode(sorted(params.items()))
+        if data:
+            request += " " + urlencode(sorted(data.items()))
+        return hashlib.sha1(request.encode()).hexdigest()
+
+    def save(self, method: str, url: str, response: requests.Response, data: dict | None = None, params: dict | None = None):
+        key = self.key(method, url, data, params)
+        meta = {
+            "method": method.upper(),
+            "url": url,
+            "data": data,
+            "params": params,
+            "status": response.status_code,
+            "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+            "encoding": response.encoding,
+        }
+        with self.lock:
+            # first recording wins, so an archive can be topped up by recording again
+            if f"{key}.json" in self.names:
+                return
+            self.zip.writestr(f"{key}.body", response.content)
+            self.zip.writestr(f"{key}.json", json.dumps(meta))
+            self.names.add(f"{key}.json")
+
+    def load(self, method: str, url: str, data: dict | None = None, params: dict | None = None) -> requests.Response:
+        key = self.key(method, url, data, params)
+        if f"{key}.json" not in self.names:
+            raise KeyError(f"no recorded response for {method.upper()} {url}")
+        with self.lock:
+            meta = json.loads(self.zip.read(f"{key}.json"))
+            body = self.zip.read(f"{key}.body")
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        response = requests.Response()
+        response.status_code = meta["status"]
+        response.headers = CaseInsensitiveDict(meta["headers"])
+        response.encoding = meta["encoding"]
+        response.url = url
+        response._content = body
+        return response
+
+    def close(self):
+        self.zip.close()
+
+
+# archive used by every HttpClient, see useArchive
+archive: FixtureArchive = None
+
+def useArchive(path: str, mode: str, latency: float = 0) -> FixtureArchive:
+    global archive
+    archive = FixtureArchive(path, mode, latency)
+    # a zip that isn't closed is missing its index, so make sure recordings get closed
+    atexit.register(archive.close)
+    return archive
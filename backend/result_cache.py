@@ -0,0 +1,128 @@
+import re, threading
+from collections import OrderedDict
+from metrics import metrics
+
+RESULT_CACHE_ENTRIES = 1024
+# approximate, measured as the length of the result's text form, which is what the model gets sent
+RESULT_CACHE_BYTES = 32 << 20
+
+# single quoted sql literals, with '' as an escaped quote
+SQL_LITERAL = re.compile(r"('(?:[^']|'')*')")
+WHITESPACE = re.compile(r"\s+")
+# comment markers, or a subquery or boolean operator that can widen a filter beyond the terms it names
+SQL_COMMENT = re.compile(r"--|/\*")
+WIDENING = re.compile(r"\b(OR|NOT|SELECT|EXISTS|UNION|INTERSECT|EXCEPT)\b", re.IGNORECASE)
+ORDER_BY = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+TERM_COLUMN = re.compile(r"\b(term|quarter)\b", re.IGNORECASE)
+# comparisons a query can be narrowed to terms by, e.g. quarter = 'Fall 2025', term IN (2258, 2254)
+# the value has to end the condition, so an expression like term = 2254 + 4 doesn't count as a filter on 2254
+TERM_FILTER = re.compile(r"\b(term|quarter)\s*(=|\bI?LIKE\b|\bIN\b)\s*(\(\s*[^()]*\)|'[^']*'|\d+)(?=\s*(?:\b(?:AND|OR|ORDER|GROUP|LIMIT)\b|\)|;|$))", re.IGNORECASE)
+FILTER_VALUE = re.compile(r"'([^']*)'|(\d+)")
+QUARTER_NAME = re.compile(r"(Winter|Spring|Summer|Fall) (\d{4})", re.IGNORECASE)
+SEASON_CODES = {"winter": 0, "spring": 2, "summer": 4, "fall": 8}
+
+# cache key for a query: whitespace outside string literals doesn't change a query, so it doesn't get its own entry
+# queries with comments are left as they are, a line comment ends at a newline, so folding it would change the query
+def normalizeSql(sql: str) -> str:
+    parts = SQL_LITERAL.split(sql.strip())
+    if any(SQL_COMMENT.search(part) for part in parts[::2]):
+        return sql.strip()
+    return "".join(part if i % 2 else WHITESPACE.sub(" ", part) for i, part in enumerate(parts)).strip().rstrip(";").rstrip()
+
+# Fall 2025 to 2258
+def quarterToTerm(season: str, year: str) -> int:
+    return 2000 + int(year) % 100 * 10 + SEASON_CODES[season.lower()]
+
+# the terms a query can return rows from, or None if it may read any term
+# only exact term or quarter values (=, IN, or LIKE without wildcards) narrow a query, anything else
+# (no filter, <>, ranges, patterns, OR, NOT, subqueries, comments) is taken to depend on every term
+def queryTerms(sql: str) -> frozenset[int] | None:
+    # keywords inside string literals (e.g. name LIKE '%Or%') don't count
+    code = " ".join(SQL_LITERAL.split(sql)[::2])
+    # the leading SELECT is the query itself, any other one is a subquery
+    if SQL_COMMENT.search(code) or len(WIDENING.findall(code)) != 1 or not code.lstrip().upper().startswith("SELECT"):
+        return None
+    # the trailing ORDER BY names term without filtering on it
+    parts = ORDER_BY.split(sql)
+    where = " ORDER BY ".join(parts[:-1]) if len(parts) > 1 else sql
+    filters = TERM_FILTER.findall(where)
+    if not filters or len(filters) != len(TERM_COLUMN.findall(where)):
+        return None
+    terms = set()
+    for column, operator, value in filters:
+        values = FILTER_VALUE.findall(value)
+        if not values:
+            return None
+        for literal, number in values:
+            text = (literal or number).strip()
+            if operator.upper() != "=" and operator.upper() != "IN" and ("%" in text or "_" in text):
+                return None
+            if column.lower() == "quarter":
+                match = QUARTER_NAME.fullmatch(text)
+                if not match:
+                    return None
+                terms.add(quarterToTerm(*match.groups()))
+            elif text.isdigit():
+                terms.add(int(text))
+            else:
+                return None
+    return frozenset(terms)
+
+
+# LRU cache of retrieve_specific results keyed by normalized sql
+# each entry remembers the data versions of the terms it was read from, and is only served while those
+# haven't been bumped, so a scrape of the open terms leaves cached results for past terms alone
+class ResultCache:
+    def __init__(self, max_entries: int = RESULT_CACHE_ENTRIES, max_bytes: int = RESULT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # sql -> (terms, versions, rows, size)
+        self.entries = OrderedDict()
+        self.size = 0
+
+    # the versions an entry for `terms` depends on, all of them if terms is None
+    @staticmethod
+    def _versions(terms: frozenset[int] | None, versions: dict[int, int]):
+        if terms is None:
+            return tuple(sorted(versions.items()))
+        return tuple((term, versions.get(term)) for term in sorted(terms))
+
+    def get(self, sql: str, versions: dict[int, int] | None):
+        if versions is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(sql)
+            if entry is not None:
+                terms, cached_versions, rows, size = entry
+                if cached_versions == self._versions(terms, versions):
+                    self.entries.move_to_end(sql)
+                    metrics.count("sql_cache_hits")
+                    return rows
+                self._remove(sql)
+                metrics.count("sql_cache_stale")
+        metrics.count("sql_cache_misses")
+        return None
+
+    def put(self, sql: str, versions: dict[int, int] | None, rows):
+        if versions is None:
+            return
+        size = len(str(rows))
+        if size > self.max_bytes:
+            return
+        terms = queryTerms(sql)
+        with self.lock:
+            if sql in self.entries:
+                self._remove(sql)
+            self.entries[sql] = (terms, self._versions(terms, versions), rows, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                metrics.count("sql_cache_evictions")
+
+    def _remove(self, sql: str):
+        self.size -= self.entries.pop(sql)[3]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size}
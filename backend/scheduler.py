@@ -0,0 +1,105 @@
+import heapq, time
+from typing import Callable
+
+# refresh intervals in seconds for each kind of term, as (starting, fastest, slowest)
+# past terms aren't scheduled at all
+INTERVALS = {
+    "open": (300, 120, 1800),
+    "upcoming": (3600, 900, 4 * 3600),
+}
+# share of sections changed in one refresh that counts as high churn
+HIGH_CHURN = 0.05
+BACKOFF = 1.5
+TERM_LIST_REFRESH = 6 * 3600
+# seconds before asking again after the term list couldn't be fetched
+TERM_LIST_RETRY = 300
+
+
+# keeps an adaptive refresh interval per term
+# intervals back off when nothing changed and tighten when a lot did
+# each schedule has its own generation, queue entries from a replaced schedule are recognized by it
+class TermSchedule:
+    def __init__(self, term: int, kind: str, generation: int = 0):
+        self.term = term
+        self.kind = kind
+        self.generation = generation
+        self.interval, self.fastest, self.slowest = INTERVALS[kind]
+
+    def adapt(self, changed: int, total: int):
+        if changed == 0:
+            self.interval = min(self.slowest, self.interval * BACKOFF)
+        elif total and changed / total >= HIGH_CHURN:
+            self.interval = max(self.fastest, self.interval / 2)
+
+
+# long running loop that refreshes each term when it's due
+# refresh(term) returns (sections changed, sections total), classify() returns {term: "open" or "upcoming"}
+class ScrapeScheduler:
+    def __init__(self, refresh: Callable[[int], tuple[int, int]], classify: Callable[[], dict[int, str]]):
+        self.refresh = refresh
+        self.classify = classify
+        self.schedules = {}
+        # (due, generation, term)
+        self.queue = []
+        self.generations = 0
+        # None until the term list was first checked
+        self.classified_at = None
+
+    def _updateTerms(self):
+        try:
+            kinds = self.classify()
+        except Exception as e:
+            # keep refreshing the terms already known, and ask again sooner than usual
+            print(f"term list update failed, keeping the current schedules: {e}")
+            self.classified_at = time.monotonic() - TERM_LIST_REFRESH + TERM_LIST_RETRY
+            return
+        self.classified_at = time.monotonic()
+        for term, kind in kinds.items():
+            schedule = self.schedules.get(term)
+            if schedule is None or schedule.kind != kind:
+                # a reclassified term is refreshed right away, its old queue entry is dropped when it comes up
+                self.generations += 1
+                self.schedules[term] = TermSchedule(term, kind, self.generations)
+                heapq.heappush(self.queue, (time.monotonic(), self.generations, term))
+        # terms that dropped off the term list are past terms now, stop refreshing them
+        for term in list(self.schedules):
+            if term not in kinds:
+                print(f"{term} is no longer listed, unscheduling")
+                del self.schedules[term]
+
+    def runOnce(self):
+        if self.classified_at is None or time.monotonic() - self.classified_at >= TERM_LIST_REFRESH:
+            self._updateTerms()
+
+        if not self.queue:
+            print("no terms to refresh, checking the term list again later")
+            time.sleep(TERM_LIST_RETRY if not self.schedules else TERM_LIST_REFRESH)
+            self.classified_at = None
+            return
+
+        due, generation, term = heapq.heappop(self.queue)
+        schedule = self.schedules.get(term)
+        # stale queue entry for a term that was unscheduled or reclassified
+        if schedule is None or schedule.generation != generation:
+            return
+        # wake up for the next term list check if it comes first, the entry goes back in the queue
+        wake = min(due, self.classified_at + TERM_LIST_REFRESH)
+        time.sleep(max(0, wake - time.monotonic()))
+        if wake < due:
+            heapq.heappush(self.queue, (due, generation, term))
+            return
+
+        start = time.monotonic()
+        try:
+            changed, total = self.refresh(term)
+            schedule.adapt(changed, total)
+            print(f"{term} ({schedule.kind}): {changed}/{total} changed in {time.monotonic() - start:.1f}s, next refresh in {schedule.interval / 60:.1f} min")
+        except Exception as e:
+            # retry at the fastest rate rather than giving up on the term
+            print(f"{term}: refresh failed: {e}")
+            schedule.interval = schedule.fastest
+        heapq.heappush(self.queue, (time.monotonic() + schedule.interval, generation, term))
+
+    def run(self):
+        while True:
+            self.runOnce()
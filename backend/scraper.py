@@ -1,28 +1,170 @@
-import requests, json, sys, os, re, concurrent.futures, time
+import json, sys, os, re, concurrent.futures, time, queue, threading
 from bs4 import BeautifulSoup, SoupStrainer
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
 from dotenv import load_dotenv
+from lxml import html as lxml_html, etree
 from multiprocessing import Pool
 from supabase import create_client, Client
 from tqdm import tqdm # optional, shows progress bar
+from http_client import HttpClient
+from detail_cache import DetailCache, DETAIL_CACHE_TTL
+from snapshot import SnapshotStore, ENROLLMENT_SNAPSHOT_PATH
+from scheduler import ScrapeScheduler
+from replay import useArchive
+from metrics import metrics
+from course import Section, Enrollment
+from bulk_writer import createWriter, SupabaseBulkWriter, PostgresBulkWriter, BATCH_SIZE, WRITE_CONCURRENCY
+from data_version import bumpDataVersion
 import argparse
+from typing import Iterable, Iterator
 
 URL = "https://pisa.ucsc.edu/class_search/index.php"
 TERM_LIST_URL = "https://my.ucsc.edu/PSIGW/RESTListeningConnector/PSFT_CSPRD/SCX_CLASS_TERMS.v1"
 
 PISA_API = "https://my.ucsc.edu/PSIGW/RESTListeningConnector/PSFT_CSPRD/SCX_CLASS_DETAIL.v1/"
 MAX_RESULTS = "2000"
+# deletions are skipped when a scrape lists fewer than this fraction of the sections the term had before
+MIN_LISTED_FRACTION = 0.5
+DETAIL_RATE_LIMIT = 20
+DETAIL_CONCURRENCY = 8
+PAGE_CONCURRENCY = 4
+TERM_CONCURRENCY = 4
+PARSERS = ["bs4", "lxml"]
+
+# equivalent of the ".panel.panel-default.row" selector
+PANEL_XPATH = (
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' panel ')"
+    " and contains(concat(' ', normalize-space(@class), ' '), ' panel-default ')"
+    " and contains(concat(' ', normalize-space(@class), ' '), ' row ')]"
+)
+# the few fields --enrollment-only needs, see parseEnrollment
+COL_XS_6 = "contains(concat(' ', normalize-space(@class), ' '), ' col-xs-6 ')"
+ENROLLMENT_XPATHS = {
+    "class_nbr": etree.XPath("(.//div/a)[1]"),
+    "status": etree.XPath("(.//h2//*[contains(concat(' ', normalize-space(@class), ' '), ' sr-only ')])[1]"),
+    "locations": etree.XPath("count(.//*[contains(concat(' ', normalize-space(@class), ' '), ' fa-location-arrow ')])"),
+    "summer": etree.XPath("boolean(.//*[contains(concat(' ', normalize-space(@class), ' '), ' fa-calendar ')])"),
+    "col_4": etree.XPath(f".//*[{COL_XS_6}][count(preceding-sibling::*) = 3]"),
+    "col_5": etree.XPath(f".//*[{COL_XS_6}][count(preceding-sibling::*) = 4]"),
+}
+# start of each panel in the raw html, and how many panels go to a worker process at a time
+PANEL_START = re.compile(rb'<div[^>]*class="panel panel-default row"')
+PANELS_PER_CHUNK = 50
+# panels submitted to the parse threads at once, and sections buffered between parsing and writing
+PARSE_WINDOW = 128
+STREAM_QUEUE_SIZE = 1000
+
+# pooled client for search requests, shared by every term so they reuse connections
+# its concurrency is the budget for search requests in flight across all terms
+search_client = HttpClient(max_concurrency=PAGE_CONCURRENCY, stage="search_fetch")
+# process pool shared by every term when parsing with --parse-workers, set up in main
+parse_pool: ProcessPoolExecutor = None
+# threads that parse panels (and fetch their class details with -g), shared by every page of every term so
+# --term-concurrency and --page-concurrency don't multiply them, replaced in main to fit the options
+parse_executor = ThreadPoolExecutor(max(os.cpu_count() or 1, DETAIL_CONCURRENCY), thread_name_prefix="parse")
+# shared by every thread fetching class details, replaced in main if limits are given on the command line
+detail_client = HttpClient(rate=DETAIL_RATE_LIMIT, max_concurrency=DETAIL_CONCURRENCY, stage="detail_fetch")
+# on-disk cache of class detail responses, set up in main
+detail_cache: DetailCache = None
+# hashes of the last enrollment values written by --enrollment-only, set up in main
+# full scrapes write enrollment too, so they save the enrollment of the sections they write here as well
+enrollment_snapshots: SnapshotStore = None
+# writes the data_versions table the chat server's query cache is invalidated by, set up in main
+version_writer: SupabaseBulkWriter | PostgresBulkWriter = None
+
+# raised by the panel parsers once the error is recorded in the metrics, so callers can tell a panel that
+# failed from one that's skipped on purpose (external classes come back as None)
+class PanelError(Exception):
+    pass
+
+# what a term's results pages listed, filled in while the term is parsed
+# ids has the section id of every panel whether or not it parsed, failures counts panels that failed to parse
+# or whose class details couldn't be fetched, truncated is set when a page came back cut off at MAX_RESULTS
+# sections missing from a listing with failures, or a truncated one, may still exist
+class Listing:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = set()
+        self.failures = 0
+        self.truncated = False
+
+    def add(self, ids: Iterable[str | None]):
+        with self.lock:
+            for id in ids:
+                if id is None:
+                    # a panel without a class number can't be told apart from a missing one
+                    self.failures += 1
+                else:
+                    self.ids.add(id)
+
+    def fail(self, count: int = 1):
+        with self.lock:
+            self.failures += count
+
+    def truncate(self):
+        with self.lock:
+            self.truncated = True
+
+    # why sections missing from the listing can't be taken as removed, or None if they can
+    # besides failures and truncation, an empty listing or one with under MIN_LISTED_FRACTION of the `previous`
+    # section count is more likely a PISA error page than that many sections being dropped
+    def incomplete(self, previous: int) -> str | None:
+        with self.lock:
+            if self.failures:
+                return f"{self.failures} panels failed"
+            if self.truncated:
+                return f"results were cut off at {MAX_RESULTS}"
+            if not self.ids:
+                return "no panels were listed"
+            if len(self.ids) < previous * MIN_LISTED_FRACTION:
+                return f"only {len(self.ids)} of {previous} known sections were listed"
+            return None
+
+# section id of a panel from its class number link, without parsing the rest of it (same id as the parsers give)
+def panelId(panel, term: str) -> str | None:
+    if isinstance(panel, etree._Element):
+        links = ENROLLMENT_XPATHS["class_nbr"](panel)
+        text = links[0].text_content() if links else None
+    else:
+        links = panel.select("div > a", limit=1)
+        text = links[0].text if links else None
+    if text is None:
+        return None
+    return str(term)+"_"+str(int(text) if text.isdigit() else 0)
 
 # query and get latest terms
 # schema: terms: list of {code: int, descsription: str, default: "Y" or "N"}
 def getLatestTerms() -> list[dict]:
-    response = requests.get(TERM_LIST_URL)
+    response = search_client.get(TERM_LIST_URL)
     terms = json.loads(response.text)
     return terms['terms']
 
+# adds gen ed, long name, description, requirements and notes from the class detail API to a section
+def addDetailedInfo(section: Section, term: str, id: int):
+    pisa_api_response = detail_cache.fetch(detail_client, term, id) if detail_cache else detail_client.get(PISA_API + f'{term}/{id}').json()
+    if "primary_section" in pisa_api_response:
+        if "gened" in pisa_api_response["primary_section"]:
+            section.gen_ed = pisa_api_response["primary_section"]["gened"]
+        if "title_long" in pisa_api_response["primary_section"]:
+            section.name = pisa_api_response["primary_section"]["title_long"]
+        if "description" in pisa_api_response["primary_section"]:
+            section.description = pisa_api_response["primary_section"]["description"]
+
+        # exp
+        if "requirements" in pisa_api_response["primary_section"]:
+            section.requirements = pisa_api_response["primary_section"]["requirements"]
+    if "notes" in pisa_api_response and pisa_api_response["notes"][0]:
+        section.notes = pisa_api_response["notes"][0]
+    elif "notes" in pisa_api_response:
+        section.notes = pisa_api_response["notes"]
+    else:
+        # default to empty string to avoid null error
+        section.notes = ""
+
 # takes in a single panel from BS4 and parses it into a dictionary
 # delegate used in the multithreading in queryPisa
-def parseSinglePanel(panel, term: str, detailed: bool) -> dict:
+def parseSinglePanel(panel, term: str, detailed: bool) -> Section:
 
     try:
 
@@ -67,62 +209,194 @@ def parseSinglePanel(panel, term: str, detailed: bool) -> dict:
         id = int(panel_div_A) if panel_div_A.isdigit() else 0
         combined_id = str(term)+"_"+str(id)
 
-        section = {
-            "id": combined_id,
-            "term": term,
-            "department": department,
-            "course_number": course_number,
-            "course_letter": course_letter,
-            "section_number": section_number,
-            "short_name": description,
-            "instructor": panel_nth_child_2[0].text.split(": ")[1].replace(",", ", ").strip(),
-            "location": panel.select(".col-xs-6:nth-child(1)")[1].text.split(": ", 1)[1].strip(),
-            "time": panel_nth_child_2[1].text.split(": ")[1].strip() if len(panel_nth_child_2[1].text.split(": ")) > 1 else "None",
-            "alt_location": panel.select(".col-xs-6:nth-child(3)")[0].text.split(": ", 1)[1].strip() if locations > 1 else "None",
-            "alt_time": panel_nth_child_4.text.split(": ")[1].strip() if locations > 1 else "None",
-            "enrolled": panel.select(".col-xs-6:nth-child({})".format(5 if summer else 4))[enrolled_index].text.strip(),
-            "type": panel.select("b")[0].text.strip(),
-            "summer_session": panel_nth_child_4.text.split(": ")[1].strip() if summer else "None",
-            "url": panel.select("a")[0]['href'].strip(),
-            "status": panel.select("h2 .sr-only")[0].text.strip()
-        }
+        section = Section(
+            id=combined_id,
+            term=term,
+            department=department,
+            course_number=course_number,
+            course_letter=course_letter,
+            section_number=section_number,
+            short_name=description,
+            instructor=panel_nth_child_2[0].text.split(": ")[1].replace(",", ", ").strip(),
+            location=panel.select(".col-xs-6:nth-child(1)")[1].text.split(": ", 1)[1].strip(),
+            time=panel_nth_child_2[1].text.split(": ")[1].strip() if len(panel_nth_child_2[1].text.split(": ")) > 1 else "None",
+            alt_location=panel.select(".col-xs-6:nth-child(3)")[0].text.split(": ", 1)[1].strip() if locations > 1 else "None",
+            alt_time=panel_nth_child_4.text.split(": ")[1].strip() if locations > 1 else "None",
+            enrolled=panel.select(".col-xs-6:nth-child({})".format(5 if summer else 4))[enrolled_index].text.strip(),
+            type=panel.select("b")[0].text.strip(),
+            summer_session=panel_nth_child_4.text.split(": ")[1].strip() if summer else "None",
+            url=panel.select("a")[0]['href'].strip(),
+            status=panel.select("h2 .sr-only")[0].text.strip()
+        )
 
         try:
-            int(section["course_number"])
+            int(section.course_number)
         except ValueError:
-            # print("invalid course_number", section["course_number"])
+            # print("invalid course_number", section.course_number)
             # only a few classes do this and they're all listed as "external", so skip if it's not valid so the upload doesn't fail.
             return
 
         if detailed:
-            pisa_api_response = json.loads(requests.get(PISA_API + f'{term}/{id}').text)
-            if "primary_section" in pisa_api_response:
-                if "gened" in pisa_api_response["primary_section"]:
-                    section["gen_ed"] = pisa_api_response["primary_section"]["gened"]
-                if "title_long" in pisa_api_response["primary_section"]:
-                    section["name"] = pisa_api_response["primary_section"]["title_long"]
-                if "description" in pisa_api_response["primary_section"]:
-                    section["description"] = pisa_api_response["primary_section"]["description"]
-
-                # exp
-                if "requirements" in pisa_api_response["primary_section"]:
-                    section["requirements"] = pisa_api_response["primary_section"]["requirements"]
-            if "notes" in pisa_api_response and pisa_api_response["notes"][0]:
-                section["notes"] = pisa_api_response["notes"][0]
-            elif "notes" in pisa_api_response:
-                section["notes"] = pisa_api_response["notes"]
-            else:
-                # default to empty string to avoid null error
-                section["notes"] = ""
+            addDetailedInfo(section, term, id)
+
+        return section
+    except Exception as e:
+        metrics.error("panel_parse", e)
+        raise PanelError(str(e)) from e
+
+
+# walks the element children of `parent` in document order
+# yields (element, position among its element siblings, whether it's inside an h2)
+def _walkPanel(parent, in_h2: bool = False):
+    position = 0
+    for child in parent:
+        # skip comments and processing instructions, nth-child only counts elements
+        if not isinstance(child.tag, str):
+            continue
+        position += 1
+        yield child, position, in_h2
+        yield from _walkPanel(child, in_h2 or child.tag == "h2")
+
+# same output as parseSinglePanel, but takes an lxml element and visits every node once
+# instead of running a separate CSS query for each field
+def parseSinglePanelLxml(panel, term: str, detailed: bool) -> Section:
+
+    try:
+
+        locations = 0
+        summer = False
+        first_a = None
+        first_div_a = None
+        first_b = None
+        status = None
+        # col-xs-6 elements bucketed by nth-child position, in document order
+        cols = {}
+
+        for el, position, in_h2 in _walkPanel(panel):
+            tag = el.tag
+            if tag == "a":
+                if first_a is None:
+                    first_a = el
+                if first_div_a is None and el.getparent().tag == "div":
+                    first_div_a = el
+            elif tag == "b" and first_b is None:
+                first_b = el
+
+            classes = el.get("class")
+            if classes is None:
+                continue
+            classes = classes.split()
+            if "col-xs-6" in classes:
+                cols.setdefault(position, []).append(el)
+            if "fa-location-arrow" in classes:
+                locations += 1
+            if "fa-calendar" in classes:
+                summer = True
+            if "sr-only" in classes and in_h2 and status is None:
+                status = el.text_content()
+
+        name = first_a.text_content().replace("\xa0\xa0\xa0", ' ').strip()
+
+        course = name.split(" - ")
+        primary = course[0].split(" ", maxsplit=1)
+        secondary = course[1].split(" ", maxsplit=1)
+
+        department = primary[0].strip()
+        full_course_number = primary[1].strip()
+        course_number = full_course_number
+
+        course_match = re.match(r'(\d+)(\D*)', full_course_number)
+        course_letter = " "
+
+        if course_match:
+            course_number = course_match.group(1)
+            course_letter = course_match.group(2)
+
+        try:
+            int(course_number)
+        except ValueError:
+            # see parseSinglePanel, external classes have non-numeric course numbers
+            return
+
+        # split each needed field once
+        col_1 = cols.get(1, [])
+        col_2 = [el.text_content() for el in cols.get(2, [])]
+        col_4_fields = cols[4][0].text_content().split(": ")
+        time_fields = col_2[1].split(": ")
+
+        if summer:
+            enrolled_index = 0
+        else:
+            enrolled_index = min(locations-1, 1)
+
+        panel_div_A = first_div_a.text_content()
+        id = int(panel_div_A) if panel_div_A.isdigit() else 0
+        combined_id = str(term)+"_"+str(id)
+
+        section = Section(
+            id=combined_id,
+            term=term,
+            department=department,
+            course_number=course_number,
+            course_letter=course_letter,
+            section_number=secondary[0].strip(),
+            short_name=secondary[1].strip(),
+            instructor=col_2[0].split(": ")[1].replace(",", ", ").strip(),
+            location=col_1[1].text_content().split(": ", 1)[1].strip(),
+            time=time_fields[1].strip() if len(time_fields) > 1 else "None",
+            alt_location=cols[3][0].text_content().split(": ", 1)[1].strip() if locations > 1 else "None",
+            alt_time=col_4_fields[1].strip() if locations > 1 else "None",
+            enrolled=cols[5 if summer else 4][enrolled_index].text_content().strip(),
+            type=first_b.text_content().strip(),
+            summer_session=col_4_fields[1].strip() if summer else "None",
+            url=first_a.get("href").strip(),
+            status=status.strip()
+        )
+
+        if detailed:
+            addDetailedInfo(section, term, id)
 
         return section
     except Exception as e:
-        print(f"Exception: {e}")
+        metrics.error("panel_parse", e)
+        raise PanelError(str(e)) from e
+
+# minimal parse of an lxml panel for --enrollment-only, returns just the id, enrollment and status
+# enrollment is located the same way as in parseSinglePanel
+def parseEnrollment(panel, term: str) -> Enrollment:
+    try:
+        locations = int(ENROLLMENT_XPATHS["locations"](panel))
+        summer = ENROLLMENT_XPATHS["summer"](panel)
+        enrolled_index = 0 if summer else min(locations-1, 1)
+
+        class_nbr = ENROLLMENT_XPATHS["class_nbr"](panel)[0].text_content()
+        id = int(class_nbr) if class_nbr.isdigit() else 0
+
+        return Enrollment(
+            id=str(term)+"_"+str(id),
+            enrolled=ENROLLMENT_XPATHS["col_5" if summer else "col_4"](panel)[enrolled_index].text_content().strip(),
+            status=ENROLLMENT_XPATHS["status"](panel)[0].text_content().strip()
+        )
+    except Exception as e:
+        metrics.error("enrollment_parse", e)
         return None
 
+# returns the panels in a results page along with the delegate that parses them
+def selectPanels(content: bytes, parser: str) -> tuple[list, callable]:
+    with metrics.time("html_parse"):
+        if parser == "lxml":
+            doc = lxml_html.fromstring(content)
+            panels = doc.xpath(PANEL_XPATH)
+            return panels, parseSinglePanelLxml
+
+        strainedSoup = SoupStrainer(class_="panel panel-default row") # doesnt help much tbh
+        doc = BeautifulSoup(content, features='lxml', parse_only=strainedSoup)
+        #print(f"Time to make BS4 object: {time.time() - startTime} seconds")
 
-def queryPisa(term: str, detailed: bool = False) -> list[dict]:
-    info = {
+        return doc.select(".panel.panel-default.row"), parseSinglePanel
+
+def buildSearchQuery(term: str, rec_start: int = 0, rec_dur: str = MAX_RESULTS) -> dict:
+    return {
         "action": "results",
         "binds[:term]": term,
         "binds[:reg_status]": "all",
@@ -144,38 +418,410 @@ def queryPisa(term: str, detailed: bool = False) -> list[dict]:
         "binds[:hybrid]": "H",
         "binds[:synch]": "S",
         "binds[:person]": "P",
-        "rec_start": "0",
-        "rec_dur": MAX_RESULTS
+        "rec_start": str(rec_start),
+        "rec_dur": str(rec_dur)
     }
-    sections = []
-
 
-    response = requests.post(URL, data=info)
-    strainedSoup = SoupStrainer(class_="panel panel-default row") # doesnt help much tbh
-    doc = BeautifulSoup(response.content, features='lxml', parse_only=strainedSoup)
-    #print(f"Time to make BS4 object: {time.time() - startTime} seconds")
+# splits a raw results page into chunks of whole panels, so they can be parsed in separate processes
+def splitPanels(content: bytes) -> list[bytes]:
+    starts = [match.start() for match in PANEL_START.finditer(content)]
+    bounds = starts + [len(content)]
+    return [content[bounds[i]:bounds[min(i+PANELS_PER_CHUNK, len(starts))]] for i in range(0, len(starts), PANELS_PER_CHUNK)]
+
+# process pool delegate, parses a chunk of panels without detailed info
+# sections come back packed, which is cheaper to send between processes than pickled objects
+# also returns the panel ids, the number of panels that failed and the worker's metrics for the chunk,
+# since they'd otherwise stay in the worker process
+def parsePanelChunk(chunk: bytes, term: str, parser: str) -> tuple[int, list[str | None], int, list[bytes], dict]:
+    metrics.clear()
+    panels, parsePanel = selectPanels(chunk, parser)
+    packed = []
+    failures = 0
+    for panel in panels:
+        try:
+            section = parsePanelTimed(parsePanel, panel, term, False)
+        except PanelError:
+            failures += 1
+            continue
+        if section:
+            packed.append(section.pack())
+    return len(panels), [panelId(panel, term) for panel in panels], failures, packed, metrics.snapshot()
+
+# parses a panel, timing the parse separately from the class detail request
+# raises PanelError if the panel or its class details couldn't be parsed
+def parsePanelTimed(parsePanel: callable, panel, term: str, detailed: bool) -> Section:
+    with metrics.time("panel_parse"):
+        section = parsePanel(panel, term, False)
+    if section and detailed:
+        return addDetailedInfoToSection(section, term)
+    return section
+
+# thread pool delegate for sections parsed in worker processes, raises PanelError if the details can't be fetched
+def addDetailedInfoToSection(section: Section, term: str) -> Section:
+    try:
+        addDetailedInfo(section, term, int(section.id.split("_")[1]))
+        return section
+    except Exception as e:
+        metrics.error("detail_fetch", e)
+        raise PanelError(str(e)) from e
 
-    panels = doc.select(".panel.panel-default.row")
-    
-    with ThreadPoolExecutor() as executor:
-        future_to_section = {executor.submit(parseSinglePanel, panel, term, detailed): panel for panel in panels}
+# like addDetailedInfoToSection, but counts a failure in `listing` and returns None instead of raising
+def addDetailedInfoOrFail(section: Section, term: str, listing: Listing | None) -> Section | None:
+    try:
+        return addDetailedInfoToSection(section, term)
+    except PanelError:
+        if listing:
+            listing.fail()
+        return None
 
-        with tqdm(total=len(panels), desc="Processing panels") as pbar:
-            for future in concurrent.futures.as_completed(future_to_section):
+# parses the page in worker processes, yielding sections in page order
+# returns the number of panels on the page
+def iterPisaPageProcesses(content: bytes, term: str, detailed: bool, pbar: tqdm, parser: str, process_pool: ProcessPoolExecutor, listing: Listing = None) -> Iterator[Section]:
+    chunks = splitPanels(content)
+    pbar.total += sum(chunk.count(b"panel panel-default row") for chunk in chunks)
+    pbar.refresh()
+
+    panel_count = 0
+    for chunk_panel_count, chunk_ids, chunk_failures, packed_sections, chunk_metrics in process_pool.map(parsePanelChunk, chunks, repeat(term), repeat(parser)):
+        panel_count += chunk_panel_count
+        metrics.merge(chunk_metrics)
+        if listing:
+            listing.add(chunk_ids)
+            listing.fail(chunk_failures)
+        chunk_sections = [Section.unpack(packed) for packed in packed_sections]
+        if detailed:
+            chunk_sections = [section for section in parse_executor.map(addDetailedInfoOrFail, chunk_sections, repeat(term), repeat(listing)) if section]
+        yield from chunk_sections
+        pbar.update(chunk_panel_count)
+
+    return panel_count
+
+# like executor.map, but in completion order and with at most `window` items submitted at a time
+# so a page's panels aren't all turned into futures at once
+def boundedMap(executor: ThreadPoolExecutor, fn, items: list, window: int) -> Iterator:
+    items = iter(items)
+    in_flight = set()
+    for item in items:
+        in_flight.add(executor.submit(fn, item))
+        if len(in_flight) >= window:
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from done
+    for future in concurrent.futures.as_completed(in_flight):
+        yield future
+
+# parses one page of search results, yielding sections as they're parsed
+# returns the number of panels on the page
+# every panel is recorded in `listing`, along with the ones that failed
+def iterPisaPage(content: bytes, term: str, detailed: bool, pbar: tqdm, parser: str = "bs4", process_pool: ProcessPoolExecutor = None, listing: Listing = None) -> Iterator[Section]:
+    if process_pool:
+        return (yield from iterPisaPageProcesses(content, term, detailed, pbar, parser, process_pool, listing))
+
+    panels, parsePanel = selectPanels(content, parser)
+    if listing:
+        listing.add(panelId(panel, term) for panel in panels)
+    if pbar.total is not None:
+        pbar.total += len(panels)
+        pbar.refresh()
+
+    for future in boundedMap(parse_executor, lambda panel: parsePanelTimed(parsePanel, panel, term, detailed), panels, PARSE_WINDOW):
+        try:
+            section = future.result()
+            # if the course number isn't a number the function returns none, so a check is needed
+            if section:
+                yield section
+        except PanelError:
+            # already recorded in the metrics
+            if listing:
+                listing.fail()
+        except Exception as e:
+            metrics.error("panel_parse", e)
+            if listing:
+                listing.fail()
+        finally:
+            pbar.update(1)
+
+    return len(panels)
+
+def fetchPisaPage(client: HttpClient, term: str, rec_start: int, rec_dur: int) -> bytes:
+    response = client.post(URL, data=buildSearchQuery(term, rec_start, rec_dur))
+    response.raise_for_status()
+    return response.content
+
+# fetches rec_start/rec_dur windows in parallel, parsing each page as soon as it arrives
+# keeps at most `concurrency` pages in flight, and stops once a page comes back short
+def iterPisaPaginated(term: str, detailed: bool, page_size: int, concurrency: int, parser: str, process_pool: ProcessPoolExecutor, listing: Listing = None) -> Iterator[Section]:
+    client = search_client
+    next_start = 0
+    last_page_seen = False
+
+    with ThreadPoolExecutor(concurrency) as executor, tqdm(total=0, desc=f"Processing {term}") as pbar:
+        in_flight = {}
+        for _ in range(concurrency):
+            in_flight[executor.submit(fetchPisaPage, client, term, next_start, page_size)] = next_start
+            next_start += page_size
+
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                rec_start = in_flight.pop(future)
                 try:
-                    section = future.result()
-                    # if the course number isn't a number the function returns none, so a check is needed
-                    if section:
-                        sections.append(section)
+                    content = future.result()
                 except Exception as e:
-                    print(f"Error processing course: {str(e)}")
-                finally:
-                    pbar.update(1)
+                    # a failed page would silently drop sections, so fail the term instead
+                    raise RuntimeError(f"failed to fetch page at rec_start={rec_start} for {term}") from e
+                panel_count = yield from iterPisaPage(content, term, detailed, pbar, parser, process_pool, listing)
+
+                if panel_count < page_size:
+                    last_page_seen = True
+                elif not last_page_seen:
+                    in_flight[executor.submit(fetchPisaPage, client, term, next_start, page_size)] = next_start
+                    next_start += page_size
+
+# yields sections as they're parsed, see queryPisa for the options
+# an existing process_pool can be passed in to share parse workers between terms
+# the panels listed (and any that failed) are recorded in `listing` if one is given
+def iterPisa(term: str, detailed: bool = False, page_size: int = 0, concurrency: int = PAGE_CONCURRENCY, parser: str = "bs4", parse_workers: int = 0, process_pool: ProcessPoolExecutor = None, listing: Listing = None) -> Iterator[Section]:
+    if process_pool:
+        yield from iterPisaWithPool(term, detailed, page_size, concurrency, parser, process_pool, listing)
+    elif parse_workers > 0:
+        with ProcessPoolExecutor(parse_workers) as process_pool:
+            yield from iterPisaWithPool(term, detailed, page_size, concurrency, parser, process_pool, listing)
+    else:
+        yield from iterPisaWithPool(term, detailed, page_size, concurrency, parser, None, listing)
+
+def iterPisaWithPool(term: str, detailed: bool, page_size: int, concurrency: int, parser: str, process_pool: ProcessPoolExecutor, listing: Listing = None) -> Iterator[Section]:
+    if page_size > 0:
+        yield from iterPisaPaginated(term, detailed, page_size, concurrency, parser, process_pool, listing)
+        return
+
+    response = search_client.post(URL, data=buildSearchQuery(term))
+    with tqdm(total=0, desc=f"Processing {term}") as pbar:
+        panel_count = yield from iterPisaPage(response.content, term, detailed, pbar, parser, process_pool, listing)
+
+    if panel_count >= int(MAX_RESULTS):
+        print(f"warning: {term} returned {panel_count} panels, results may be cut off at {MAX_RESULTS} (use --page-size)")
+        if listing:
+            listing.truncate()
+
+# page_size > 0 enables paginated mode, otherwise everything is requested in one MAX_RESULTS-sized page
+# parse_workers > 0 parses panels in that many processes instead of threads
+def queryPisa(term: str, detailed: bool = False, page_size: int = 0, concurrency: int = PAGE_CONCURRENCY, parser: str = "bs4", parse_workers: int = 0) -> list[Section]:
+    return list(iterPisa(term, detailed, page_size, concurrency, parser, parse_workers))
+
+# runs `iterable` in a background thread and hands its items over through a bounded queue
+# the producer blocks when the queue is full, so parsing can't run ahead of writing
+# an exception in the producer is appended to `errors` after everything before it has been yielded
+def bufferedIter(iterable: Iterator, maxsize: int, errors: list) -> Iterator:
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while (item := items.get()) is not done:
+            yield item
+    finally:
+        # let the producer exit if the consumer stopped early
+        stop.set()
+        while producer.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+# fetches a term and returns (enrollment rows for known sections, fully parsed sections that weren't seen before)
+# new sections still need every column, so only those go through the full parser
+def queryEnrollment(term: str, known_ids: set[str]) -> tuple[list[Enrollment], list[Section]]:
+    response = search_client.post(URL, data=buildSearchQuery(term))
+    panels = lxml_html.fromstring(response.content).xpath(PANEL_XPATH)
+    if len(panels) >= int(MAX_RESULTS):
+        print(f"warning: {term} returned {len(panels)} panels, results may be cut off at {MAX_RESULTS}")
+
+    enrollments = []
+    new_sections = []
+    for panel in panels:
+        enrollment = parseEnrollment(panel, term)
+        if enrollment is None:
+            continue
+        if enrollment.id in known_ids:
+            enrollments.append(enrollment)
+        else:
+            try:
+                section = parseSinglePanelLxml(panel, term, False)
+            except PanelError:
+                continue
+            if section:
+                new_sections.append(section)
+    return enrollments, new_sections
+
+# the full scrape hashes of sections whose enrollment changed are dropped, since those rows no longer
+# match them, and the new sections' enrollment hashes are saved along with them
+def refreshEnrollment(writer: SupabaseBulkWriter | PostgresBulkWriter, snapshots: SnapshotStore, enrollment_snapshots: SnapshotStore, term: int) -> tuple[int, int]:
+    enrollments, new_sections = queryEnrollment(term, snapshots.knownIds(term))
+
+    if new_sections:
+        print(f"{term}: {len(new_sections)} new sections")
+        writer.upsert(new_sections)
+        snapshots.save(term, new_sections, [], False)
+        enrollment_snapshots.save(term, [section.enrollment() for section in new_sections], [], False)
+
+    # deleted sections are left to full scrapes
+    inserts, updates, _ = enrollment_snapshots.diff(term, enrollments, False)
+    changed = inserts + updates
+    print(f"{term}: {len(changed)} enrollment changes, {len(enrollments) - len(changed)} unchanged")
+    writer.update(changed)
+    snapshots.invalidate([enrollment.id for enrollment in changed])
+    enrollment_snapshots.save(term, changed, [], False)
+    return len(changed) + len(new_sections), len(enrollments) + len(new_sections)
+
+# streams sections into the database in batches, upserting only the ones that changed since the last run
+# batches are written (and recorded in the snapshot) as soon as they fill up, so a failure partway through
+# a term keeps everything parsed before it. deletions are only worked out once the whole term was parsed,
+# from the panels in `listing` (parsed or not), and are skipped if the listing is incomplete (see Listing.incomplete)
+# written sections overwrite columns the other kind of scrape's hashes cover, so those are invalidated,
+# and their enrollment is saved to `enrollment_snapshots` for --enrollment-only runs to compare against
+def upsertSections(writer: SupabaseBulkWriter | PostgresBulkWriter, snapshots: SnapshotStore, term: int, sections: Iterable[Section], detailed: bool, full_upsert: bool = False, delete_missing: bool = False, batch_size: int = BATCH_SIZE, listing: Listing = None, enrollment_snapshots: SnapshotStore = None) -> tuple[int, int]:
+    previous = snapshots.load(term, detailed)
+    seen = set()
+    batch = []
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+
+    def flush():
+        inserts, updates = snapshots.diffAgainst(previous, batch)
+        counts["new"] += len(inserts)
+        counts["changed"] += len(updates)
+        counts["unchanged"] += len(batch) - len(inserts) - len(updates)
+        changed = batch if full_upsert else inserts + updates
+        writer.upsert(changed)
+        written = [section.id for section in changed]
+        snapshots.invalidate(written, not detailed)
+        if enrollment_snapshots:
+            enrollment_snapshots.save(term, [section.enrollment() for section in changed], [], False)
+        snapshots.save(term, changed, [], detailed)
+        batch.clear()
+
+    errors = []
+    for section in bufferedIter(sections, STREAM_QUEUE_SIZE, errors):
+        seen.add(section.id)
+        batch.append(section)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    if errors:
+        print(f"{term}: parsing failed after {len(seen)} sections, kept {counts['new']} new and {counts['changed']} changed")
+        raise errors[0]
+
+    listing = listing or Listing()
+    listing.add(seen)
+    seen = listing.ids
+    reason = listing.incomplete(len(previous)) if previous else None
+    if reason:
+        # a section whose panel or details failed, or that was cut off, isn't gone, it just wasn't seen this time
+        print(f"{term}: {reason}, not removing missing sections")
+        deletions = []
+    else:
+        deletions = [id for id in previous if id not in seen]
+    if deletions and delete_missing:
+        writer.delete("id", deletions)
+    snapshots.save(term, [], deletions, detailed)
+
+    print(f"{term}: {counts['new']} new, {counts['changed']} changed, {counts['unchanged']} unchanged, {len(deletions)} removed")
+    for name, count in counts.items():
+        metrics.count(f"sections_{name}", count)
+    metrics.count("sections_removed", len(deletions))
+    return counts["new"] + counts["changed"] + len(deletions), len(seen)
+
+# returns (sections changed, sections total)
+# the term's data version is bumped whenever anything was written, so cached query results for it are dropped
+def scrapeTerm(writer: SupabaseBulkWriter | PostgresBulkWriter, snapshots: SnapshotStore, term: int, args: argparse.Namespace) -> tuple[int, int]:
+    try:
+        if args.enrollment_only:
+            changed, total = refreshEnrollment(writer, snapshots, enrollment_snapshots, term)
+        else:
+            listing = Listing()
+            sections = iterPisa(term, args.get_detail, args.page_size, args.page_concurrency, args.parser, args.parse_workers, parse_pool, listing)
+            changed, total = upsertSections(writer, snapshots, term, sections, args.get_detail, args.full_upsert, args.delete_missing, args.batch_size, listing, enrollment_snapshots)
+    except Exception:
+        # batches written before the failure changed the term too
+        if version_writer:
+            bumpDataVersion(version_writer, term)
+        raise
+    if changed and version_writer:
+        bumpDataVersion(version_writer, term)
+    return changed, total
+
+# scrapes terms concurrently, up to --term-concurrency at a time
+# all of them share the search client, parse pool and threads, detail client and course writer, so those limits are global
+def scrapeTerms(writer: SupabaseBulkWriter | PostgresBulkWriter, snapshots: SnapshotStore, terms: list[int], args: argparse.Namespace):
+    def scrapeTimed(term: int) -> float:
+        print("scraping " + str(term))
+        start = time.perf_counter()
+        changed, total = scrapeTerm(writer, snapshots, term, args)
+        elapsed = time.perf_counter() - start
+        print(f"{term}: finished in {elapsed:.1f}s, {changed} of {total} sections changed")
+        return elapsed
+
+    start = time.perf_counter()
+    failures = []
+    with ThreadPoolExecutor(args.term_concurrency) as executor:
+        future_to_term = {executor.submit(scrapeTimed, term): term for term in terms}
+        for future in concurrent.futures.as_completed(future_to_term):
+            try:
+                future.result()
+            except Exception as e:
+                # let the other terms finish before failing
+                print(f"{future_to_term[future]}: failed: {e}")
+                metrics.error("scrape_term", e)
+                failures.append(e)
+    print(f"scraped {len(terms) - len(failures)} of {len(terms)} terms in {time.perf_counter() - start:.1f}s")
+
+    if failures:
+        raise failures[0]
+
+# adds terms from the term list API that aren't in stored_term_list to the terms table (and to stored_term_list)
+def uploadNewTerms(supabase: Client, latest_terms: list[dict], stored_term_list: list[int], copy: bool = False):
+    new_pairs = []
+    for term in latest_terms:
+        code = int(term["code"])
+        desc_list = str(term["description"]).split()
+        # 2026 Winter Quarter to Winter 2026
+        desc = f"{desc_list[1]} {desc_list[0]}"
+        if code and code not in stored_term_list:
+            print("adding ", code)
+            stored_term_list.append(code)
+            new_pairs.append({"term_id": code, "term_name": desc})
+    
+    if len(new_pairs) > 0:
+        print("uploading ",new_pairs)
+        term_writer = createWriter(supabase, "terms", copy)
+        term_writer.upsert(new_pairs)
+        term_writer.close()
 
-    return sections
-            
+# terms still listed by the term list API can change, the default one is the term currently in registration
+# anything no longer listed is a past term and doesn't need refreshing
+def classifyTerms(latest_terms: list[dict]) -> dict[int, str]:
+    return {int(term["code"]): "open" if term.get("default") == "Y" else "upcoming" for term in latest_terms if int(term["code"])}
 
 def main():
+    global search_client, parse_pool, parse_executor, detail_client, detail_cache, enrollment_snapshots, version_writer
     load_dotenv()
     url: str = os.environ.get("SUPABASE_URL")
     key: str = os.environ.get("SUPABASE_KEY")
@@ -187,10 +833,37 @@ def main():
     parser.add_argument("-g", "--get-detail", action="store_true", help="Get detailed info.")
     parser.add_argument("-a", "--all-terms", action="store_true", help="Scrape all terms.")
     parser.add_argument("-u", "--update-terms", action="store_true", help="Update term list.", default=True)
+    parser.add_argument("-d", "--daemon", action="store_true", help="Keep running and refresh each listed term on its own adaptive schedule.")
+    parser.add_argument("-e", "--enrollment-only", action="store_true", help="Only refresh enrollment and status (new sections are still scraped in full).")
+    parser.add_argument("-p", "--page-size", type=int, default=0, help="Fetch results in pages of this size (default: single request).")
+    parser.add_argument("--page-concurrency", type=int, default=PAGE_CONCURRENCY, help="Number of search requests in flight at once, across all terms.")
+    parser.add_argument("-c", "--term-concurrency", type=int, default=TERM_CONCURRENCY, help="Number of terms to scrape at once.")
+    parser.add_argument("--parser", choices=PARSERS, default="bs4", help="Panel parser engine (lxml walks each panel once and is much faster).")
+    parser.add_argument("-w", "--parse-workers", type=int, default=0, help="Parse panels in this many processes (default: threads in one process, one per cpu, shared by every term).")
+    parser.add_argument("--detail-rate", type=float, default=DETAIL_RATE_LIMIT, help="Max class detail requests per second with -g (0 for no limit).")
+    parser.add_argument("--detail-concurrency", type=int, default=DETAIL_CONCURRENCY, help="Max class detail requests in flight with -g.")
+    parser.add_argument("--detail-cache-ttl", type=int, default=DETAIL_CACHE_TTL, help="Seconds before cached class details for the two newest terms are refetched.")
+    parser.add_argument("--no-detail-cache", action="store_true", help="Always fetch class details from PISA (implied by --record and --replay).")
+    parser.add_argument("--full-upsert", action="store_true", help="Upsert every section, not just the ones that changed since the last run.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows per upsert request.")
+    parser.add_argument("--write-concurrency", type=int, default=WRITE_CONCURRENCY, help="Upsert requests in flight at once.")
+    parser.add_argument("--copy", action="store_true", help="Write directly to postgres (SUPABASE_CONN_STRING) with COPY instead of the supabase api.")
+    parser.add_argument("--delete-missing", action="store_true", help="Delete sections that are no longer listed on PISA.")
+
+    parser.add_argument("--record", metavar="ARCHIVE", help="Save every PISA response to a fixture archive. Skips the class detail cache, so every detail response is recorded.")
+    parser.add_argument("--replay", metavar="ARCHIVE", help="Serve PISA responses from a fixture archive instead of the network. Skips the class detail cache.")
+    parser.add_argument("--replay-latency", type=float, default=0, help="Seconds of latency to add to each replayed response.")
+    parser.add_argument("--metrics-json", metavar="PATH", help="Write a JSON summary of per-stage timings, counters and errors.")
+    parser.add_argument("--metrics-prom", metavar="PATH", help="Write the run metrics in Prometheus text format (e.g. for the node exporter textfile collector).")
 
     # Parse arguments
     args = parser.parse_args()
 
+    if args.record:
+        useArchive(args.record, "record")
+    elif args.replay:
+        useArchive(args.replay, "replay", args.replay_latency)
+
     # term_list = [2260, 2258, 2254, 2252, 2250, 2248, 2244, 2242, 2240, 2238, 2234, 2232, 2230, 2228, 2224]
     stored_term_list_raw = supabase.table("terms").select("term_id").execute()
     stored_term_list = []
@@ -202,24 +875,9 @@ def main():
     stored_term_list.sort(reverse=True)
 
     print(stored_term_list)
-    new_pairs = []
-
     if args.update_terms:
         print("updating term list")
-        latest_terms = getLatestTerms()
-        for term in latest_terms:
-            code = int(term["code"])
-            desc_list = str(term["description"]).split()
-            # 2026 Winter Quarter to Winter 2026
-            desc = f"{desc_list[1]} {desc_list[0]}"
-            if code and code not in stored_term_list:
-                print("adding ", code)
-                stored_term_list.append(code)
-                new_pairs.append({"term_id": code, "term_name": desc})
-        
-        if len(new_pairs) > 0:
-            print("uploading ",new_pairs)
-            supabase.table("terms").upsert(new_pairs).execute()
+        uploadNewTerms(supabase, getLatestTerms(), stored_term_list, args.copy)
     
     # get final term list
     term_list = sorted(stored_term_list, reverse=True)
@@ -227,29 +885,73 @@ def main():
 
     if args.get_detail:
         print("getting detailed info")
+        detail_client = HttpClient(rate=args.detail_rate, max_concurrency=args.detail_concurrency, stage="detail_fetch")
+        # cache hits never reach the archive, so recordings (and the replays of them) go without the cache
+        if not args.no_detail_cache and not args.record and not args.replay:
+            # past terms don't change, only the current and upcoming term need refreshing
+            detail_cache = DetailCache(ttl=args.detail_cache_ttl, live_terms=term_list[:2])
+
+    search_client = HttpClient(max_concurrency=args.page_concurrency, stage="search_fetch")
+    if args.parse_workers > 0:
+        parse_pool = ProcessPoolExecutor(args.parse_workers)
+    # with -g the parse threads also wait on class details, so there are enough of them to keep those in flight
+    parse_executor = ThreadPoolExecutor(max(args.parse_workers or os.cpu_count() or 1, args.detail_concurrency if args.get_detail else 0), thread_name_prefix="parse")
+
+    snapshots = SnapshotStore()
+    # opened for full scrapes too, which invalidate the enrollment hashes of the sections they write
+    enrollment_snapshots = SnapshotStore(ENROLLMENT_SNAPSHOT_PATH)
+    course_writer = createWriter(supabase, "courses", args.copy, args.batch_size, args.write_concurrency)
+    version_writer = createWriter(supabase, "data_versions", args.copy)
+
+    if args.daemon:
+        print("running as a daemon")
+        def classify() -> dict[int, str]:
+            # only the term list API is queried each cycle, new terms are added to the database as they show up
+            latest_terms = getLatestTerms()
+            uploadNewTerms(supabase, latest_terms, term_list, args.copy)
+            schedules = classifyTerms(latest_terms)
+            # details of the listed terms can still change, a term that stops being listed is cached for good
+            if detail_cache:
+                detail_cache.live_terms = {str(term) for term in schedules}
+            return schedules
+        def refresh(term: int) -> tuple[int, int]:
+            try:
+                return scrapeTerm(course_writer, snapshots, term, args)
+            finally:
+                # metrics keep accumulating over the daemon's lifetime, rewrite the files after every refresh
+                metrics.export("scraper", args.metrics_json, args.metrics_prom)
+        ScrapeScheduler(refresh, classify).run()
 
     if args.term and args.all_terms:
         print("specific term and all terms were selected, will scrape all terms")
 
     if args.all_terms:
         print("getting every term")
-        for term in term_list:
-            print("scraping " + str(term))
-            sections = queryPisa(term, args.get_detail)
-            supabase.table("courses").upsert(sections).execute()
+        scrapeTerms(course_writer, snapshots, term_list, args)
     elif args.term:
         if args.term in term_list:
             print("scraping specific term: " + str(args.term))
-            sections = queryPisa(args.term, args.get_detail)
-            supabase.table("courses").upsert(sections).execute()
+            scrapeTerms(course_writer, snapshots, [args.term], args)
         else:
             print(f"{args.term} not in {term_list}")
     else:
         terms = [term_list[0], term_list[1]]
         print("scraping " + str(terms))
-        for term in terms:
-            sections = queryPisa(term, args.get_detail)
-            supabase.table("courses").upsert(sections).execute()
+        scrapeTerms(course_writer, snapshots, terms, args)
+
+    course_writer.close()
+    version_writer.close()
+    if parse_pool:
+        parse_pool.shutdown()
+    parse_executor.shutdown()
+
+    if args.get_detail:
+        detail_client.printStats("class detail api")
+        if detail_cache:
+            detail_cache.printStats("class detail cache")
+
+    metrics.printSummary()
+    metrics.export("scraper", args.metrics_json, args.metrics_prom)
 
 if __name__ == "__main__":
     main()
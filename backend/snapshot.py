@@ -0,0 +1,86 @@
+import os, sqlite3, threading
+from course import Record
+
+SNAPSHOT_PATH = "cache/section_snapshots.sqlite"
+ENROLLMENT_SNAPSHOT_PATH = "cache/enrollment_snapshots.sqlite"
+
+# local record of what was last upserted for each section, as content hashes keyed by section id
+# detailed and basic scrapes upsert different columns, so they're tracked separately
+class SnapshotStore:
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # shared by concurrently scraped terms, sqlite calls are serialized with the lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS section_hashes ("
+            "id TEXT NOT NULL, detailed INTEGER NOT NULL, term TEXT NOT NULL, hash TEXT NOT NULL, "
+            "PRIMARY KEY (id, detailed))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS section_hashes_term ON section_hashes (term, detailed)")
+        self.conn.commit()
+
+    def load(self, term, detailed: bool) -> dict[str, str]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, hash FROM section_hashes WHERE term = ? AND detailed = ?",
+                (str(term), int(detailed))
+            )
+            return dict(rows.fetchall())
+
+    # ids of every section upserted for the term, by either kind of scrape
+    def knownIds(self, term) -> set[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT id FROM section_hashes WHERE term = ?", (str(term),))
+            return {row[0] for row in rows.fetchall()}
+
+    # returns (inserts, updates, deleted ids) compared to the last saved snapshot of the term
+    def diff(self, term, sections: list[Record], detailed: bool) -> tuple[list[Record], list[Record], list[str]]:
+        previous = self.load(term, detailed)
+        inserts, updates = self.diffAgainst(previous, sections)
+        seen = {section.id for section in sections}
+        deletions = [id for id in previous if id not in seen]
+        return inserts, updates, deletions
+
+    # returns (inserts, updates) compared to hashes from load(), for diffing a term a batch at a time
+    def diffAgainst(self, previous: dict[str, str], sections: list[Record]) -> tuple[list[Record], list[Record]]:
+        inserts = []
+        updates = []
+        for section in sections:
+            old_hash = previous.get(section.id)
+            if old_hash is None:
+                inserts.append(section)
+            elif old_hash != section.contentHash():
+                updates.append(section)
+        return inserts, updates
+
+    # call once the delta has been written, so a failed upsert is retried on the next run
+    def save(self, term, sections: list[Record], deletions: list[str], detailed: bool):
+        hashes = [(section.id, int(detailed), str(term), section.contentHash()) for section in sections]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO section_hashes (id, detailed, term, hash) VALUES (?, ?, ?, ?)",
+                hashes
+            )
+            self.conn.executemany(
+                "DELETE FROM section_hashes WHERE id = ? AND detailed = ?",
+                [(id, int(detailed)) for id in deletions]
+            )
+            self.conn.commit()
+
+    # forgets the hashes of sections another kind of scrape just wrote (all kinds if detailed is None),
+    # so the next diff writes them again instead of comparing against values the database no longer has
+    # the ids are kept, knownIds still counts them
+    def invalidate(self, ids: list[str], detailed: bool | None = None):
+        with self.lock:
+            if detailed is None:
+                self.conn.executemany("UPDATE section_hashes SET hash = '' WHERE id = ?", [(id,) for id in ids])
+            else:
+                self.conn.executemany(
+                    "UPDATE section_hashes SET hash = '' WHERE id = ? AND detailed = ?",
+                    [(id, int(detailed)) for id in ids]
+                )
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
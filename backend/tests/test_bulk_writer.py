@@ -0,0 +1,72 @@
+import os, uuid
+import psycopg2
+import pytest
+from bulk_writer import PostgresBulkWriter
+
+# runs against a scratch postgres database, e.g. a local one, in tables created and dropped by each test
+PG_CONN_STRING = os.environ.get("PG_CONN_STRING")
+pytestmark = pytest.mark.skipif(not PG_CONN_STRING, reason="PG_CONN_STRING isn't set")
+
+@pytest.fixture
+def table():
+    name = f"bulk_writer_test_{uuid.uuid4().hex[:8]}"
+    with psycopg2.connect(PG_CONN_STRING) as conn, conn.cursor() as cur:
+        cur.execute(f'CREATE TABLE "{name}" (id TEXT PRIMARY KEY, name TEXT NOT NULL, enrolled TEXT, meta JSONB)')
+    yield name
+    with psycopg2.connect(PG_CONN_STRING) as conn, conn.cursor() as cur:
+        cur.execute(f'DROP TABLE "{name}"')
+    conn.close()
+
+def rows(table: str) -> dict:
+    with psycopg2.connect(PG_CONN_STRING) as conn, conn.cursor() as cur:
+        cur.execute(f'SELECT id, name, enrolled, meta FROM "{table}"')
+        result = {row[0]: row[1:] for row in cur.fetchall()}
+    conn.close()
+    return result
+
+
+def test_upsert_copies_and_merges(table):
+    writer = PostgresBulkWriter(PG_CONN_STRING, table)
+    # values COPY's text format has to escape
+    writer.upsert([
+        {"id": "1", "name": "tab\there", "enrolled": "1 of 2", "meta": {"notes": ["a\\b"]}},
+        {"id": "2", "name": "new\nline", "enrolled": None, "meta": None},
+    ])
+    assert rows(table) == {
+        "1": ("tab\there", "1 of 2", {"notes": ["a\\b"]}),
+        "2": ("new\nline", None, None),
+    }
+
+    # conflicting rows are updated in place, rows of a different shape only set their own columns
+    writer.upsert([
+        {"id": "1", "name": "renamed", "enrolled": "2 of 2", "meta": None},
+        {"id": "2", "name": "partial"},
+        {"id": "3", "name": "added", "enrolled": "0 of 5", "meta": []},
+    ])
+    assert rows(table) == {
+        "1": ("renamed", "2 of 2", None),
+        "2": ("partial", None, None),
+        "3": ("added", "0 of 5", []),
+    }
+    writer.close()
+
+def test_update_only_touches_existing_rows(table):
+    writer = PostgresBulkWriter(PG_CONN_STRING, table)
+    writer.upsert([{"id": "1", "name": "kept", "enrolled": "1 of 2", "meta": None}])
+    writer.update([{"id": "1", "enrolled": "2 of 2"}, {"id": "missing", "enrolled": "9 of 9"}])
+    assert rows(table) == {"1": ("kept", "2 of 2", None)}
+
+    writer.delete("id", ["1"])
+    assert rows(table) == {}
+    writer.close()
+
+def test_table_without_primary_key_is_refused(table):
+    with psycopg2.connect(PG_CONN_STRING) as conn, conn.cursor() as cur:
+        cur.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT "{table}_pkey"')
+    conn.close()
+    writer = PostgresBulkWriter(PG_CONN_STRING, table)
+    with pytest.raises(ValueError, match="no primary key"):
+        writer.upsert([{"id": "1", "name": "a"}])
+    with pytest.raises(ValueError, match="no primary key"):
+        writer.update([{"id": "1", "name": "a"}])
+    writer.close()
@@ -0,0 +1,105 @@
+import os
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from lxml import html as lxml_html
+from tqdm import tqdm
+from replay import FixtureArchive
+from scraper import selectPanels, parseSinglePanelLxml, parseEnrollment, panelId, iterPisaPage, splitPanels, buildSearchQuery, Listing, PANEL_XPATH, URL
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# results pages in PISA's markup, with regular, multi-location (two and three locations), TBA, summer session
+# and external panels
+PAGES = {
+    "2258": "pisa_results_2258.html",
+    "2254": "pisa_results_2254.html",
+}
+
+# search responses saved with --record, replayed the way the scraper reads them
+# 2258 was recorded from the local stand-in server used for benchmarks, 120 panels so it splits into several chunks
+RECORDED = {
+    "2258": "pisa_record_2258.zip",
+}
+
+def loadPage(term: str) -> bytes:
+    with open(os.path.join(FIXTURES, PAGES[term]), "rb") as file:
+        return file.read()
+
+def loadRecordedPage(term: str) -> bytes:
+    archive = FixtureArchive(os.path.join(FIXTURES, RECORDED[term]), "replay")
+    try:
+        return archive.load("POST", URL, buildSearchQuery(term)).content
+    finally:
+        archive.close()
+
+def parsePage(term: str, parser: str) -> list:
+    return parseContent(loadPage(term), term, parser)
+
+def parseContent(content: bytes, term: str, parser: str) -> list:
+    panels, parsePanel = selectPanels(content, parser)
+    return [parsePanel(panel, term, False) for panel in panels]
+
+
+@pytest.mark.parametrize("term", PAGES)
+def test_lxml_parser_matches_bs4(term):
+    expected = parsePage(term, "bs4")
+    actual = parsePage(term, "lxml")
+    assert actual == expected
+    # external panels are skipped by both
+    assert None in expected
+
+
+def test_fixtures_cover_panel_layouts():
+    sections = [section for term in PAGES for section in parsePage(term, "bs4") if section]
+    assert any(section.summer_session != "None" for section in sections)
+    assert any(section.alt_location != "None" for section in sections)
+    assert any(section.time == "None" for section in sections)
+
+
+@pytest.mark.parametrize("term", PAGES)
+@pytest.mark.parametrize("parser", ["bs4", "lxml"])
+def test_panel_ids_match_parsed_ids(term, parser):
+    panels, parsePanel = selectPanels(loadPage(term), parser)
+    for panel in panels:
+        section = parsePanel(panel, term, False)
+        if section:
+            assert panelId(panel, term) == section.id
+
+
+# --enrollment-only compares against hashes saved by full scrapes, so both have to read the same values
+@pytest.mark.parametrize("term", PAGES)
+def test_enrollment_matches_sections(term):
+    panels = lxml_html.fromstring(loadPage(term)).xpath(PANEL_XPATH)
+    for panel in panels:
+        section = parseSinglePanelLxml(panel, term, False)
+        if section:
+            assert parseEnrollment(panel, term) == section.enrollment()
+
+
+@pytest.mark.parametrize("term", RECORDED)
+def test_lxml_parser_matches_bs4_on_recorded_page(term):
+    content = loadRecordedPage(term)
+    expected = parseContent(content, term, "bs4")
+    assert len(expected) == content.count(b"panel panel-default row")
+    assert parseContent(content, term, "lxml") == expected
+
+
+# --parse-workers splits the page into chunks of panels, which has to give the same sections and listing
+@pytest.mark.parametrize("term", RECORDED)
+@pytest.mark.parametrize("parser", ["bs4", "lxml"])
+def test_process_pool_matches_threads_on_recorded_page(term, parser):
+    content = loadRecordedPage(term)
+    assert len(splitPanels(content)) > 1
+
+    thread_listing = Listing()
+    threaded = list(iterPisaPage(content, term, False, tqdm(total=0, disable=True), parser, listing=thread_listing))
+    pool_listing = Listing()
+    with ProcessPoolExecutor(2) as pool:
+        pooled = list(iterPisaPage(content, term, False, tqdm(total=0, disable=True), parser, pool, pool_listing))
+
+    # threads yield sections in completion order, the pool in page order
+    assert sorted(pooled, key=lambda section: section.id) == sorted(threaded, key=lambda section: section.id)
+    assert pooled == [section for section in parseContent(content, term, parser) if section]
+    assert pool_listing.ids == thread_listing.ids
+    assert len(pool_listing.ids) == content.count(b"panel panel-default row")
+    assert pool_listing.incomplete(len(pool_listing.ids)) is None
@@ -0,0 +1,30 @@
+import io, json
+import pytest
+from process_grades import iter_json_array
+
+GRADES = [
+    {"termCode": 2248, "class": "CSE 101", "title": "Data Structures", "instructors": ["Ann Lee"], "gradeCounts": {"A": 10, "B-": 3}},
+    {"termCode": 2252, "class": "MATH 19A", "title": "Calculus, \"Part\" 1 [x]", "instructors": [], "gradeCounts": {}},
+    [1, 2, {"nested": "]"}],
+]
+
+
+# chunk sizes that cut elements, strings and separators at every position
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1 << 16])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_yields_every_element(chunk_size, indent):
+    file = io.StringIO(json.dumps(GRADES, indent=indent))
+    assert list(iter_json_array(file, chunk_size)) == GRADES
+
+@pytest.mark.parametrize("text", ["[]", "  [ ]  ", "\n[\n]\n"])
+def test_empty_array(text):
+    assert list(iter_json_array(io.StringIO(text), 1)) == []
+
+@pytest.mark.parametrize("text, error", [
+    ('{"a": 1}', "not a JSON array"),
+    ('[{"a": 1}, ', "unexpected end"),
+    ('[{"a": 1}, {"b": ', "Expecting value"),
+])
+def test_malformed_input(text, error):
+    with pytest.raises(ValueError, match=error):
+        list(iter_json_array(io.StringIO(text), 4))
@@ -0,0 +1,59 @@
+import pytest
+from result_cache import normalizeSql, queryTerms
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT * FROM courses", "SELECT * FROM courses"),
+    ("  SELECT *\n  FROM   courses\tWHERE term = 2258  ", "SELECT * FROM courses WHERE term = 2258"),
+    ("SELECT * FROM courses;", "SELECT * FROM courses"),
+    ("SELECT * FROM courses ;", "SELECT * FROM courses"),
+    ("SELECT * FROM courses ;\n", "SELECT * FROM courses"),
+    # whitespace inside literals is part of the value
+    ("SELECT * FROM courses WHERE name = 'Intro  to   CS'", "SELECT * FROM courses WHERE name = 'Intro  to   CS'"),
+    ("SELECT * FROM courses WHERE name = 'it''s  here'", "SELECT * FROM courses WHERE name = 'it''s  here'"),
+    # a comment ends at a newline, folding the newline away would comment out the rest of the query
+    ("SELECT * FROM courses -- all of them\nWHERE term = 2258", "SELECT * FROM courses -- all of them\nWHERE term = 2258"),
+    ("SELECT /* every   column */ * FROM courses", "SELECT /* every   column */ * FROM courses"),
+    # comment markers inside literals are just text
+    ("SELECT *  FROM courses WHERE notes = '--'", "SELECT * FROM courses WHERE notes = '--'"),
+])
+def test_normalize_sql(sql, expected):
+    assert normalizeSql(sql) == expected
+
+def test_normalize_sql_ignores_trailing_semicolon():
+    assert normalizeSql("SELECT 1 ;") == normalizeSql("SELECT 1")
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT * FROM courses WHERE term = 2258", {2258}),
+    ("SELECT * FROM courses WHERE term = '2258'", {2258}),
+    ("SELECT * FROM courses WHERE term IN (2258, 2254)", {2258, 2254}),
+    ("SELECT * FROM courses WHERE term = 2258;", {2258}),
+    ("SELECT * FROM courses WHERE (term = 2258) AND department = 'CSE'", {2258}),
+    ("SELECT * FROM courses WHERE term = 2258 AND department = 'CSE' ORDER BY term", {2258}),
+    ("SELECT * FROM courses WHERE term = 2258 LIMIT 10", {2258}),
+    ("SELECT department, count(*) FROM courses WHERE term = 2258 GROUP BY department", {2258}),
+    ("SELECT * FROM grades WHERE quarter = 'Fall 2025'", {2258}),
+    ("SELECT * FROM grades WHERE quarter LIKE 'Winter 2024'", {2240}),
+    ("SELECT * FROM grades WHERE quarter IN ('Fall 2025', 'Spring 2025')", {2258, 2252}),
+    # keywords inside literals don't widen the query
+    ("SELECT * FROM courses WHERE term = 2258 AND name LIKE '%Or Not%'", {2258}),
+    # no term filter, or one that can read other terms
+    ("SELECT * FROM courses", None),
+    ("SELECT * FROM courses ORDER BY term", None),
+    ("SELECT * FROM courses WHERE term = 2254 + 4", None),
+    ("SELECT * FROM courses WHERE term = 2258 - 4 AND department = 'CSE'", None),
+    ("SELECT * FROM courses WHERE term > 2250", None),
+    ("SELECT * FROM courses WHERE term <> 2258", None),
+    ("SELECT * FROM courses WHERE term = 2258 OR department = 'CSE'", None),
+    ("SELECT * FROM courses WHERE NOT term = 2258", None),
+    ("SELECT * FROM grades WHERE quarter LIKE 'Fall%'", None),
+    ("SELECT * FROM grades WHERE quarter = 'Fall'", None),
+    ("SELECT * FROM courses WHERE term = 2258 AND id IN (SELECT id FROM courses)", None),
+    ("SELECT * FROM courses WHERE term = 2258 UNION SELECT * FROM courses", None),
+    ("SELECT * FROM courses WHERE term = 2258 -- AND term = 2254", None),
+    ("SELECT * FROM courses WHERE term = 2258 AND instructor = term", None),
+    ("WITH recent AS (SELECT * FROM courses) SELECT * FROM recent WHERE term = 2258", None),
+])
+def test_query_terms(sql, expected):
+    terms = queryTerms(sql)
+    assert (None if terms is None else set(terms)) == expected
@@ -0,0 +1,97 @@
+import pytest
+import scheduler
+from scheduler import TermSchedule, ScrapeScheduler, INTERVALS, BACKOFF
+
+# stands in for the time module, sleeping just moves the clock forward
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler, "time", clock)
+    return clock
+
+
+@pytest.mark.parametrize("kind", INTERVALS)
+def test_unchanged_terms_back_off_up_to_slowest(kind):
+    schedule = TermSchedule(2258, kind)
+    starting, fastest, slowest = INTERVALS[kind]
+    schedule.adapt(0, 100)
+    assert schedule.interval == starting * BACKOFF
+    for _ in range(20):
+        schedule.adapt(0, 100)
+    assert schedule.interval == slowest
+
+@pytest.mark.parametrize("kind", INTERVALS)
+def test_high_churn_tightens_down_to_fastest(kind):
+    schedule = TermSchedule(2258, kind)
+    starting, fastest, slowest = INTERVALS[kind]
+    schedule.adapt(50, 100)
+    assert schedule.interval == max(fastest, starting / 2)
+    for _ in range(20):
+        schedule.adapt(50, 100)
+    assert schedule.interval == fastest
+
+def test_low_churn_keeps_interval():
+    schedule = TermSchedule(2258, "open")
+    schedule.adapt(1, 100)
+    assert schedule.interval == INTERVALS["open"][0]
+    # nothing listed yet
+    schedule.adapt(1, 0)
+    assert schedule.interval == INTERVALS["open"][0]
+
+
+def test_refreshes_follow_the_adapted_interval(clock):
+    refreshes = []
+    def refresh(term):
+        refreshes.append(clock.now)
+        return 0, 100
+    runner = ScrapeScheduler(refresh, lambda: {2258: "open"})
+    for _ in range(3):
+        runner.runOnce()
+    starting = INTERVALS["open"][0]
+    assert refreshes == [0, starting * BACKOFF, starting * BACKOFF + starting * BACKOFF ** 2]
+
+def test_failed_refresh_retries_at_fastest(clock):
+    calls = []
+    def refresh(term):
+        calls.append(clock.now)
+        if len(calls) == 2:
+            raise ConnectionError("pisa is down")
+        return 0, 100
+    runner = ScrapeScheduler(refresh, lambda: {2258: "upcoming"})
+    for _ in range(3):
+        runner.runOnce()
+    starting, fastest, slowest = INTERVALS["upcoming"]
+    assert calls[2] - calls[1] == fastest
+    assert runner.schedules[2258].interval == fastest * BACKOFF
+
+def test_reclassified_term_is_refreshed_right_away(clock):
+    kinds = {2258: "upcoming"}
+    refreshes = []
+    def refresh(term):
+        refreshes.append((clock.now, runner.schedules[term].kind))
+        return 0, 100
+    runner = ScrapeScheduler(refresh, lambda: dict(kinds))
+    runner.runOnce()
+    kinds[2258] = "open"
+    runner.classified_at = None
+    runner.runOnce()
+    assert refreshes == [(0, "upcoming"), (0, "open")]
+
+    # the upcoming schedule's queue entry is dropped when it comes up instead of refreshing again
+    slowest = INTERVALS["upcoming"][2]
+    while clock.now < slowest + INTERVALS["open"][2]:
+        runner.runOnce()
+    open_refreshes = [now for now, kind in refreshes[1:]]
+    gaps = [later - earlier for earlier, later in zip(open_refreshes, open_refreshes[1:])]
+    assert gaps == sorted(gaps)
+    assert all(kind == "open" for now, kind in refreshes[1:])
@@ -0,0 +1,61 @@
+import pytest
+from snapshot import SnapshotStore
+from course import Section
+
+TERM = 2258
+
+def section(id: str, enrolled: str = "10 of 50") -> Section:
+    return Section(
+        id=id, term=str(TERM), department="CSE", course_number="101", course_letter="", section_number="01",
+        short_name="Data Structures", instructor="Lee,A.", location="LEC: Baskin Auditorium",
+        time="TuTh 01:30PM-03:05PM", alt_location="None", alt_time="None", enrolled=enrolled, type="In Person",
+        summer_session="None", url="https://pisa.ucsc.edu/class_search/", status="Open"
+    )
+
+@pytest.fixture
+def store(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshots.sqlite"))
+    yield store
+    store.close()
+
+
+def test_first_scrape_inserts_everything(store):
+    sections = [section("1"), section("2")]
+    assert store.diff(TERM, sections, False) == (sections, [], [])
+
+def test_diff_after_save(store):
+    store.save(TERM, [section("1"), section("2"), section("3")], [], False)
+    changed = section("2", enrolled="11 of 50")
+    added = section("4")
+    inserts, updates, deletions = store.diff(TERM, [section("1"), changed, added], False)
+    assert inserts == [added]
+    assert updates == [changed]
+    assert deletions == ["3"]
+
+    store.save(TERM, [section("1"), changed, added], deletions, False)
+    assert store.diff(TERM, [section("1"), changed, added], False) == ([], [], [])
+    assert store.knownIds(TERM) == {"1", "2", "4"}
+
+def test_diff_against_batches(store):
+    store.save(TERM, [section("1"), section("2")], [], False)
+    previous = store.load(TERM, False)
+    changed = section("2", enrolled="0 of 50")
+    assert store.diffAgainst(previous, [section("1")]) == ([], [])
+    assert store.diffAgainst(previous, [changed, section("3")]) == ([section("3")], [changed])
+
+def test_detailed_and_basic_snapshots_are_separate(store):
+    store.save(TERM, [section("1")], [], True)
+    assert store.diff(TERM, [section("1")], False) == ([section("1")], [], [])
+    assert store.diff(TERM, [section("1")], True) == ([], [], [])
+    # other terms aren't compared against
+    assert store.diff(TERM + 2, [section("1")], True) == ([section("1")], [], [])
+
+@pytest.mark.parametrize("detailed, rewritten", [(True, [True]), (None, [False, True])])
+def test_invalidate_rewrites_without_forgetting_ids(store, detailed, rewritten):
+    store.save(TERM, [section("1")], [], False)
+    store.save(TERM, [section("1")], [], True)
+    store.invalidate(["1"], detailed)
+    for kind in (False, True):
+        updates = [section("1")] if kind in rewritten else []
+        assert store.diff(TERM, [section("1")], kind) == ([], updates, [])
+    assert store.knownIds(TERM) == {"1"}
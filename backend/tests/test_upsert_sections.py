@@ -0,0 +1,92 @@
+import dataclasses, os
+import pytest
+import scraper
+from scraper import iterPisa, upsertSections, selectPanels, Listing
+from snapshot import SnapshotStore
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+TERM = "2258"
+
+class FakeWriter:
+    def __init__(self):
+        self.upserted = []
+        self.deleted = []
+
+    def upsert(self, rows):
+        self.upserted += rows
+
+    def delete(self, column, values):
+        self.deleted += values
+
+class FakeResponse:
+    def __init__(self, content: bytes):
+        self.content = content
+
+class FakeSearchClient:
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def post(self, url, **kwargs):
+        return FakeResponse(self.content)
+
+def loadPage() -> bytes:
+    with open(os.path.join(FIXTURES, f"pisa_results_{TERM}.html"), "rb") as file:
+        return file.read()
+
+# sections for the page, plus `extra` sections the term had before that the page no longer lists
+def previousSections(extra: int) -> list:
+    panels, parsePanel = selectPanels(loadPage(), "lxml")
+    sections = [section for section in (parsePanel(panel, TERM, False) for panel in panels) if section]
+    gone = [dataclasses.replace(sections[0], id=f"{TERM}_{90000 + i}") for i in range(extra)]
+    return sections + gone
+
+@pytest.fixture
+def snapshots(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshots.sqlite"))
+    yield store
+    store.close()
+
+@pytest.fixture
+def page(monkeypatch):
+    monkeypatch.setattr(scraper, "search_client", FakeSearchClient(loadPage()))
+    return monkeypatch
+
+def rescrape(snapshots, extra: int) -> tuple[FakeWriter, Listing]:
+    upsertSections(FakeWriter(), snapshots, int(TERM), previousSections(extra), False)
+    writer = FakeWriter()
+    listing = Listing()
+    upsertSections(writer, snapshots, int(TERM), iterPisa(TERM, parser="lxml", listing=listing), False, delete_missing=True, listing=listing)
+    return writer, listing
+
+
+def test_missing_sections_are_deleted(page, snapshots):
+    writer, _ = rescrape(snapshots, 1)
+    assert writer.deleted == [f"{TERM}_90000"]
+
+def test_failed_panels_skip_deletions(page, snapshots):
+    def failingDetail(section, term, id):
+        raise RuntimeError("detail fetch timed out")
+    page.setattr(scraper, "addDetailedInfo", failingDetail)
+    upsertSections(FakeWriter(), snapshots, int(TERM), previousSections(1), True)
+    writer = FakeWriter()
+    listing = Listing()
+    upsertSections(writer, snapshots, int(TERM), iterPisa(TERM, True, parser="lxml", listing=listing), True, delete_missing=True, listing=listing)
+    assert listing.failures > 0
+    assert writer.deleted == []
+
+def test_truncated_results_skip_deletions(page, snapshots):
+    page.setattr(scraper, "MAX_RESULTS", "5")
+    writer, listing = rescrape(snapshots, 1)
+    assert listing.truncated
+    assert writer.deleted == []
+
+def test_empty_results_skip_deletions(monkeypatch, snapshots):
+    monkeypatch.setattr(scraper, "search_client", FakeSearchClient(b"<html><body>No classes found.</body></html>"))
+    writer, listing = rescrape(snapshots, 1)
+    assert not listing.ids
+    assert writer.deleted == []
+
+def test_mostly_missing_results_skip_deletions(page, snapshots):
+    # the page lists 6 panels, the term had 6 + 10 sections before
+    writer, _ = rescrape(snapshots, 10)
+    assert writer.deleted == []